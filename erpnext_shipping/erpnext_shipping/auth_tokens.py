@@ -0,0 +1,81 @@
+# Copyright (c) 2023, Frappe and contributors
+# For license information, please see license.txt
+
+import frappe
+import time
+from frappe import _
+from frappe.utils import add_to_date, now_datetime, time_diff_in_seconds
+
+AUTH_TOKEN_KEY = 'erpnext_shipping:auth_token:{0}'
+AUTH_TOKEN_LOCK = 'erpnext_shipping:auth_token_lock:{0}'
+
+# Refresh this many seconds before a token expires, while it can still be used by everyone else
+REFRESH_AHEAD = 60 * 60
+# A login holding the lock longer than this is assumed dead
+LOCK_TIMEOUT = 60
+# How long a request without a usable token waits for another worker's login
+LOCK_WAIT = 30
+
+def get_auth_token(service_provider, fetch_token, valid_for):
+	"""Return a valid auth token for the provider, shared by all workers of the site.
+
+	`fetch_token()` logs in and returns a new token valid for `valid_for` seconds. It is
+	called by one worker at a time, behind a Redis lock. While a token is still valid but
+	due for refresh, the worker that gets the lock refreshes it and the others keep using
+	the current one."""
+	token = get_cached_token(service_provider)
+	if token and token['expires_at'] - time.time() > REFRESH_AHEAD:
+		return token['token']
+
+	usable = token and token['expires_at'] > time.time()
+	cache = frappe.cache()
+	lock = cache.lock(cache.make_key(AUTH_TOKEN_LOCK.format(service_provider)), timeout=LOCK_TIMEOUT)
+	if not lock.acquire(blocking=not usable, blocking_timeout=LOCK_WAIT):
+		if usable:
+			return token['token']
+		token = get_cached_token(service_provider)
+		if token:
+			return token['token']
+		frappe.throw(_('Could not get an auth token for {0}, please try again.').format(service_provider))
+
+	try:
+		# Someone else may have refreshed while we waited for the lock
+		token = get_cached_token(service_provider)
+		if token and token['expires_at'] - time.time() > REFRESH_AHEAD:
+			return token['token']
+
+		new_token = fetch_token()
+		if not new_token:
+			frappe.throw(_('Could not log in to {0}, please check the credentials.').format(service_provider))
+		set_cached_token(service_provider, new_token, valid_for)
+		return new_token
+	finally:
+		lock.release()
+
+def get_cached_token(service_provider):
+	# {'token': ..., 'expires_at': epoch seconds} or None. Falls back to the token saved in the
+	# provider's settings, so a cleared cache doesn't force a new login.
+	token = frappe.cache().get_value(AUTH_TOKEN_KEY.format(service_provider))
+	if token:
+		return token
+
+	settings = frappe.get_cached_doc(service_provider, service_provider)
+	if settings.token and settings.valid_upto:
+		remaining = time_diff_in_seconds(settings.valid_upto, now_datetime())
+		if remaining > 0:
+			token = {'token': settings.token, 'expires_at': time.time() + remaining}
+			frappe.cache().set_value(AUTH_TOKEN_KEY.format(service_provider), token, expires_in_sec=int(remaining))
+			return token
+
+def set_cached_token(service_provider, token, valid_for):
+	frappe.cache().set_value(AUTH_TOKEN_KEY.format(service_provider),
+		{'token': token, 'expires_at': time.time() + valid_for}, expires_in_sec=int(valid_for))
+	# Keep the settings in sync for reference, without touching `modified` or committing
+	frappe.db.set_value(service_provider, service_provider, {
+		'token': token,
+		'valid_upto': add_to_date(now_datetime(), seconds=valid_for)
+	}, update_modified=False)
+	frappe.clear_document_cache(service_provider, service_provider)
+
+def clear_auth_token(service_provider):
+	frappe.cache().delete_value(AUTH_TOKEN_KEY.format(service_provider))
@@ -0,0 +1,161 @@
+# Copyright (c) 2023, Frappe and contributors
+# For license information, please see license.txt
+
+import frappe
+import json
+import threading
+import time
+from functools import partial
+from frappe import _
+from frappe.utils import cint, flt, now_datetime, time_diff_in_seconds
+from erpnext_shipping.erpnext_shipping.utils import (SHIPMENT_PARCEL_FIELDS, check_shipment_permission, get_slice_jobs,
+	run_concurrently)
+
+# Bookings in flight per provider, override with `shipping_booking_concurrency` in site_config.json
+DEFAULT_BOOKING_CONCURRENCY = 2
+# Seconds a quoted rate can be booked, override per provider with `shipping_quote_validity`
+# in site_config.json, 0 books quotes of any age
+DEFAULT_QUOTE_VALIDITY = 24 * 60 * 60
+
+@frappe.whitelist()
+def enqueue_bulk_booking(shipments):
+	# Book many Shipments in the background. `shipments` is a list of Shipment names, booked with the
+	# rate quoted by bulk rate shopping, or of {"shipment": ..., "service_data": ...} with a chosen rate.
+	# Progress is published with `frappe.publish_progress`, the summary with the `bulk_booking` event.
+	bookings = [b if isinstance(b, dict) else {'shipment': b} for b in frappe.parse_json(shipments)]
+	check_shipment_permission([b['shipment'] for b in bookings], 'submit', _('Not permitted to book Shipments'))
+
+	frappe.enqueue('erpnext_shipping.erpnext_shipping.booking.bulk_booking',
+		queue='long', timeout=3600, bookings=bookings)
+	frappe.msgprint(_('Booking {0} Shipments in the background.').format(len(bookings)), alert=True)
+
+def bulk_booking(bookings):
+	# Book each Shipment on its own, providers are booked at the same time within their limits
+	summary = frappe._dict(shipments=len(bookings), booked=0, failed=[])
+	by_provider = {}
+	for booking in bookings:
+		booking = frappe._dict(booking)
+		if not booking.service_data:
+			booking.service_data, error = get_quoted_service_data(booking.shipment)
+			if error:
+				summary.failed.append({'shipment': booking.shipment, 'error': error})
+				continue
+		if not isinstance(booking.service_data, str):
+			booking.service_data = json.dumps(booking.service_data)
+		service_provider = json.loads(booking.service_data).get('service_provider')
+		by_provider.setdefault(service_provider, []).append(booking)
+
+	lock = threading.Lock()
+	rate_limits = get_rate_limiters(by_provider)
+
+	def book_slice(service_provider, booking_slice):
+		for booking in booking_slice:
+			rate_limits[service_provider]()
+			error = book_shipment(booking)
+			with lock:
+				if error:
+					summary.failed.append({'shipment': booking.shipment, 'error': error})
+				else:
+					summary.booked += 1
+				done = summary.booked + len(summary.failed)
+				frappe.publish_progress(done * 100 / summary.shipments, title=_('Booking Shipments'),
+					description=_('{0} of {1} Shipments processed').format(done, summary.shipments))
+
+	jobs = {}
+	for service_provider, provider_bookings in by_provider.items():
+		slice_jobs = get_slice_jobs(partial(book_slice, service_provider), provider_bookings,
+			get_booking_concurrency(service_provider))
+		jobs.update({(service_provider, i): job for i, job in slice_jobs.items()})
+	outcome = run_concurrently(jobs)
+	for (service_provider, i), error in outcome.errors.items():
+		frappe.log_error(title=_('Error while booking {0} Shipments').format(service_provider), message=repr(error))
+
+	frappe.publish_realtime('bulk_booking', summary, user=frappe.session.user)
+	return summary
+
+def get_quote_validity(service_provider):
+	validity = frappe.conf.get('shipping_quote_validity') or {}
+	return cint(validity.get(service_provider, DEFAULT_QUOTE_VALIDITY))
+
+def get_quoted_service_data(shipment):
+	# The rate quoted by bulk rate shopping, unless it is older than the provider's quote validity
+	quote = frappe.db.get_value('Shipment', shipment, ['quoted_service_data', 'quoted_at'], as_dict=True)
+	if not quote or not quote.quoted_service_data:
+		return None, _('No rate selected')
+	validity = get_quote_validity(frappe.parse_json(quote.quoted_service_data).get('service_provider'))
+	if validity and (not quote.quoted_at or time_diff_in_seconds(now_datetime(), quote.quoted_at) > validity):
+		return None, _('The quoted rate has expired, please fetch rates again')
+	return quote.quoted_service_data, None
+
+def book_shipment(booking):
+	# Book one Shipment, returns the error if it could not be booked
+	from erpnext_shipping.erpnext_shipping.shipping import create_shipment
+
+	frappe.local.message_log = []
+	try:
+		# The row lock is held until the booking is committed, a concurrent booking waits for it
+		# and then finds the Shipment booked
+		docstatus, shipment_id = frappe.db.get_value('Shipment', booking.shipment, ['docstatus', 'shipment_id'],
+			for_update=True) or (None, None)
+		if docstatus != 1 or shipment_id:
+			frappe.db.rollback()
+			return _('Shipment is not submitted or already booked')
+
+		shipment = frappe.get_doc('Shipment', booking.shipment)
+
+		shipment_info = create_shipment(
+			shipment=shipment.name,
+			pickup_from_type=shipment.pickup_from_type,
+			delivery_to_type=shipment.delivery_to_type,
+			pickup_address_name=shipment.pickup_address_name,
+			delivery_address_name=shipment.delivery_address_name,
+			shipment_parcel=json.dumps([{field: d.get(field) for field in SHIPMENT_PARCEL_FIELDS}
+				for d in shipment.shipment_parcel]),
+			description_of_content=shipment.description_of_content,
+			pickup_date=shipment.pickup_date,
+			value_of_goods=shipment.value_of_goods,
+			service_data=booking.service_data,
+			pickup_contact_name=shipment.pickup_contact_person if shipment.pickup_from_type == 'Company' else shipment.pickup_contact_name,
+			delivery_contact_name=shipment.delivery_contact_name,
+			delivery_notes=[d.delivery_note for d in shipment.shipment_delivery_note]
+		)
+		if not shipment_info:
+			frappe.db.rollback()
+			return get_last_message() or _('Booking failed')
+		frappe.db.commit()
+	except Exception:
+		frappe.db.rollback()
+		frappe.log_error(title=_('Error while booking Shipment {0}').format(booking.shipment))
+		return get_last_message() or _('Booking failed, see the Error Log')
+
+def get_last_message():
+	messages = [frappe.parse_json(m).get('message') for m in frappe.local.message_log]
+	return messages[-1] if messages else None
+
+def get_booking_concurrency(service_provider):
+	concurrency = (frappe.conf.get('shipping_booking_concurrency') or {}).get(service_provider)
+	return cint(concurrency) or DEFAULT_BOOKING_CONCURRENCY
+
+def get_rate_limiters(service_providers):
+	# {provider: wait()}, each call waits until the provider's next booking may start. Bookings per minute
+	# and provider are unlimited, unless set with `shipping_booking_rate_limits` in site_config.json
+	rate_limits = frappe.conf.get('shipping_booking_rate_limits') or {}
+	limiters = {}
+	for service_provider in service_providers:
+		per_minute = flt(rate_limits.get(service_provider))
+		limiters[service_provider] = make_rate_limiter(60 / per_minute if per_minute else 0)
+	return limiters
+
+def make_rate_limiter(interval):
+	lock = threading.Lock()
+	next_start = [time.monotonic()]
+
+	def wait():
+		if not interval:
+			return
+		with lock:
+			now = time.monotonic()
+			start = max(now, next_start[0])
+			next_start[0] = start + interval
+		time.sleep(start - now)
+	return wait
@@ -8,16 +8,27 @@ from frappe.custom.doctype.custom_field.custom_field import create_custom_field
 from frappe.model.document import Document
 from pytz import timezone
 from datetime import datetime
-from frappe.utils.data import add_days, flt, get_datetime, get_system_timezone, now_datetime, time_diff_in_seconds, format_datetime
+from frappe.utils.data import flt, get_datetime, get_system_timezone, format_datetime
 from frappe.utils.password import get_decrypted_password
-from frappe.integrations.utils import make_get_request, make_post_request
+from erpnext_shipping.erpnext_shipping.auth_tokens import clear_auth_token, get_auth_token
+from erpnext_shipping.erpnext_shipping import transport
 from erpnext_shipping.erpnext_shipping.utils import get_lat_long, show_error_alert
 
 DUNZO_PROVIDER = 'Dunzo'
+# Dunzo tokens are used for a day
+DUNZO_TOKEN_VALIDITY = 24 * 60 * 60
+
 class Dunzo(Document):
 	def validate(self):
 		if self.enabled:
 			self.setup_custom_fields()
+		if self.has_value_changed('api_id') or self.has_value_changed('api_password'):
+			self.token = None
+			self.valid_upto = None
+
+	def on_update(self):
+		# Credentials may have changed, log in again on next use
+		clear_auth_token(DUNZO_PROVIDER)
 	
 	def setup_custom_fields(self):
 		data_fields = [
@@ -43,29 +54,18 @@ class DunzoUtils():
 		self.check_auth_token()
 	
 	def check_auth_token(self):
-		dunzo_settings = frappe.get_doc("Dunzo")
-		if dunzo_settings.valid_upto:
-			if time_diff_in_seconds(dunzo_settings.valid_upto, now_datetime()) < 150.0:
-				self.token = self.fetch_auth_token(dunzo_settings)
-			else:
-				self.token = dunzo_settings.token
-		else:
-			self.token = self.fetch_auth_token(dunzo_settings)
+		# Tokens are shared by all workers through the cache, only one of them logs in
+		self.token = get_auth_token(DUNZO_PROVIDER, self.fetch_auth_token, valid_for=DUNZO_TOKEN_VALIDITY)
 	
-	def fetch_auth_token(self, dunzo_settings):
+	def fetch_auth_token(self):
 		url = self.base_url+"api/v1/token"
 		headers = {
 			"client-secret": self.api_password,
   			"client-id": self.api_id,
 			"Content-Type": "application/json"
 		}
-		token_response = make_get_request(url, headers=headers)
-		token = token_response.get("token")
-		dunzo_settings.token = token
-		dunzo_settings.valid_upto = add_days(now_datetime(), 1)
-		dunzo_settings.save(ignore_permissions=True)
-		frappe.db.commit()
-		return token
+		token_response = transport.make_get_request(DUNZO_PROVIDER, url, headers=headers)
+		return token_response.get("token")
 	
 	def get_available_services(self, pickup_address_gps, delivery_address_gps, cod=False, collection_amount=None):
 		if not self.enabled or not self.api_id or not self.api_password:
@@ -103,7 +103,7 @@ class DunzoUtils():
 				}
 		try:
 			available_services = []
-			response_data = make_post_request(
+			response_data = transport.make_post_request(DUNZO_PROVIDER,
 				url=url,
 				headers=headers,
 				data=json.dumps(payload)
@@ -146,7 +146,7 @@ class DunzoUtils():
 				"amount": flt(shipment.collection_amount)
 			}
 		try:
-			response_data = make_post_request(
+			response_data = transport.make_post_request(DUNZO_PROVIDER,
 				url=url,
 				headers=headers,
 				data=json.dumps(payload)
@@ -174,7 +174,7 @@ class DunzoUtils():
 			"client-id": self.api_id
 		}
 		try:
-			response_data = make_get_request(
+			response_data = transport.make_get_request(DUNZO_PROVIDER,
 				url=url,
 				headers=headers
 			)
@@ -3,13 +3,13 @@
 # For license information, please see license.txt
 
 from __future__ import unicode_literals
-import requests
 import frappe
 import json
 import re
 from frappe import _
 from frappe.model.document import Document
 from frappe.utils.password import get_decrypted_password
+from erpnext_shipping.erpnext_shipping import transport
 from erpnext_shipping.erpnext_shipping.utils import show_error_alert
 
 LETMESHIP_PROVIDER = 'LetMeShip'
@@ -55,7 +55,7 @@ class LetMeShipUtils():
 		)
 		try:
 			available_services = []
-			response_data = requests.post(
+			response_data = transport.post(LETMESHIP_PROVIDER,
 				url=url,
 				auth=(self.api_id, self.api_password),
 				headers=headers,
@@ -104,7 +104,7 @@ class LetMeShipUtils():
 			pickup_date=pickup_date,
 			service_info=service_info)
 		try:
-			response_data = requests.post(
+			response_data = transport.post(LETMESHIP_PROVIDER,
 				url=url,
 				auth=(self.api_id, self.api_password),
 				headers=headers,
@@ -115,7 +115,7 @@ class LetMeShipUtils():
 				shipment_amount = response_data['service']['priceInfo']['totalPrice']
 				awb_number = ''
 				url = 'https://api.letmeship.com/v1/shipments/{id}'.format(id=response_data['shipmentId'])
-				tracking_response = requests.get(url, auth=(self.api_id, self.api_password),headers=headers)
+				tracking_response = transport.get(LETMESHIP_PROVIDER, url, auth=(self.api_id, self.api_password),headers=headers)
 				tracking_response_data = json.loads(tracking_response.text)
 				if 'trackingData' in tracking_response_data:
 					for parcel in tracking_response_data['trackingData']['parcelList']:
@@ -144,7 +144,7 @@ class LetMeShipUtils():
 				'Access-Control-Allow-Origin': 'string'
 			}
 			url = 'https://api.letmeship.com/v1/shipments/{id}/documents?types=LABEL'.format(id=shipment_id)
-			shipment_label_response = requests.get(
+			shipment_label_response = transport.get(LETMESHIP_PROVIDER,
 				url,
 				auth=(self.api_id, self.api_password),
 				headers=headers
@@ -160,6 +160,12 @@ class LetMeShipUtils():
 		except Exception:
 			show_error_alert("printing LetMeShip Label")
 
+	def get_label_pdf(self, shipment_id):
+		# The label as PDF bytes, for the label store
+		label = self.get_label(shipment_id)
+		if label:
+			return bytes(bytearray(json.loads(label)))
+
 	def get_tracking_data(self, shipment_id):
 		from erpnext_shipping.erpnext_shipping.utils import get_tracking_url
 		# return letmeship tracking data
@@ -170,7 +176,7 @@ class LetMeShipUtils():
 		}
 		try:
 			url = 'https://api.letmeship.com/v1/tracking?shipmentid={id}'.format(id=shipment_id)
-			tracking_data_response = requests.get(
+			tracking_data_response = transport.get(LETMESHIP_PROVIDER,
 				url,
 				auth=(self.api_id, self.api_password),
 				headers=headers
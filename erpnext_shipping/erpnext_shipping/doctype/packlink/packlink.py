@@ -5,10 +5,10 @@
 from __future__ import unicode_literals
 import json
 import frappe
-import requests
 from frappe import _
 from frappe.model.document import Document
 from frappe.utils.password import get_decrypted_password
+from erpnext_shipping.erpnext_shipping import labels, transport
 from erpnext_shipping.erpnext_shipping.utils import show_error_alert
 
 PACKLINK_PROVIDER = 'Packlink'
@@ -34,7 +34,7 @@ class PackLinkUtils():
 			return []
 
 		try:
-			responses = requests.get(url, headers={'Authorization': self.api_key})
+			responses = transport.get(PACKLINK_PROVIDER, url, headers={'Authorization': self.api_key})
 			responses_dict = json.loads(responses.text)
 			# If an error occured on the api. Show the error message
 			if 'messages' in responses_dict:
@@ -88,7 +88,7 @@ class PackLinkUtils():
 			'Content-Type': 'application/json'
 		}
 		try:
-			response_data = requests.post(url, json=data, headers=headers)
+			response_data = transport.post(PACKLINK_PROVIDER, url, json=data, headers=headers)
 			response_data = json.loads(response_data.text)
 			if 'reference' in response_data:
 				return {
@@ -109,7 +109,7 @@ class PackLinkUtils():
 			'Content-Type': 'application/json'
 		}
 		try:
-			shipment_label_response = requests.get(
+			shipment_label_response = transport.get(PACKLINK_PROVIDER,
 				'https://api.packlink.com/v1/shipments/{id}/labels'.format(id=shipment_id),
 				headers=headers
 			)
@@ -124,6 +124,12 @@ class PackLinkUtils():
 			show_error_alert("printing Packlink Label")
 		return []
 
+	def get_label_pdf(self, shipment_id):
+		# The label as PDF bytes, for the label store
+		label_urls = self.get_label(shipment_id)
+		if label_urls:
+			return labels.download_labels(PACKLINK_PROVIDER, label_urls)
+
 	def get_tracking_data(self, shipment_id):
 		# Get Packlink Tracking Info
 		from erpnext_shipping.erpnext_shipping.utils import get_tracking_url
@@ -134,7 +140,7 @@ class PackLinkUtils():
 		}
 		try:
 			url = 'https://api.packlink.com/v1/shipments/{id}'.format(id=shipment_id)
-			tracking_data_response = requests.get(url, headers=headers)
+			tracking_data_response = transport.get(PACKLINK_PROVIDER, url, headers=headers)
 			tracking_data = json.loads(tracking_data_response.text)
 			if 'trackings' in tracking_data:
 				tracking_status = 'In Progress'
@@ -6,17 +6,46 @@ from __future__ import unicode_literals
 import frappe
 from frappe.model.document import Document
 
+PARCEL_SERVICE_TYPE_INDEX = 'erpnext_shipping:parcel_service_type_index'
+
 class ParcelServiceType(Document):
-	pass
+	def on_update(self):
+		clear_parcel_service_type_index()
+
+	def after_rename(self, old, new, merge=False):
+		clear_parcel_service_type_index()
+
+	def on_trash(self):
+		clear_parcel_service_type_index()
 
 def match_parcel_service_type_alias(parcel_service_type, parcel_service):
 	# Match and return Parcel Service Type Alias to Parcel Service Type if exists.
-	if frappe.db.exists('Parcel Service', parcel_service):
-		matched_parcel_service_type = \
-			frappe.db.get_value('Parcel Service Type Alias', {
-				'parcel_type_alias': parcel_service_type,
-				'parcel_service': parcel_service
-			}, 'parent')
-		if matched_parcel_service_type:
-			parcel_service_type = matched_parcel_service_type
-	return parcel_service_type
\ No newline at end of file
+	aliases = get_parcel_service_type_index()['aliases']
+	return aliases.get((parcel_service, parcel_service_type), parcel_service_type)
+
+def get_parcel_service_type_index():
+	# {'aliases': {(parcel_service, alias): parcel_service_type}, 'preferred': {parcel_service_type: 0/1}}
+	return frappe.cache().get_value(PARCEL_SERVICE_TYPE_INDEX, generator=build_parcel_service_type_index)
+
+def build_parcel_service_type_index():
+	# Aliases can only point to an existing Parcel Service, so a single query covers all lookups
+	index = {'aliases': {}, 'preferred': {}}
+	for row in frappe.db.sql("""
+		select
+			pst.name, pst.show_in_preferred_services_list,
+			alias.parcel_service, alias.parcel_type_alias
+		from `tabParcel Service Type` pst
+		left join `tabParcel Service Type Alias` alias
+			on alias.parent = pst.name and alias.parenttype = 'Parcel Service Type'
+	""", as_dict=1):
+		index['preferred'][row.name] = row.show_in_preferred_services_list
+		if row.parcel_service and row.parcel_type_alias:
+			index['aliases'][(row.parcel_service, row.parcel_type_alias)] = row.name
+	return index
+
+def clear_parcel_service_type_index():
+	from erpnext_shipping.erpnext_shipping.rate_cache import clear_rate_cache
+
+	frappe.cache().delete_value(PARCEL_SERVICE_TYPE_INDEX)
+	# cached quotes carry the matched service type and preferred flag
+	clear_rate_cache()
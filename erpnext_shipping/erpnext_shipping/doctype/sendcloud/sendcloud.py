@@ -3,20 +3,34 @@
 # For license information, please see license.txt
 
 from __future__ import unicode_literals
-import requests
 import frappe
 import json
+from bisect import bisect_right
 from frappe import _
+from functools import partial
 from frappe.utils import flt
 from frappe.model.document import Document
 from frappe.utils.password import get_decrypted_password
-from erpnext_shipping.erpnext_shipping.utils import show_error_alert
+from erpnext_shipping.erpnext_shipping import labels, transport
+from erpnext_shipping.erpnext_shipping.utils import map_requests, show_error_alert
 
 SENDCLOUD_PROVIDER = 'SendCloud'
 
-class SendCloud(Document): pass
+# Country codes in the synced shipping method catalog, the catalog is synced again once this expires
+CATALOG_SYNCED_KEY = 'erpnext_shipping:sendcloud_catalog'
+# Shipping methods to one country, by weight band
+CATALOG_COUNTRY_KEY = 'erpnext_shipping:sendcloud_catalog:{0}'
+CATALOG_TTL = 24 * 60 * 60
+
+class SendCloud(Document):
+	def on_update(self):
+		# Other credentials may see other shipping methods
+		frappe.cache().delete_value(CATALOG_SYNCED_KEY)
 
 class SendCloudUtils():
+	# Shipments tracked per get_tracking_data_batch call
+	tracking_batch_size = 100
+
 	def __init__(self):
 		self.api_secret = get_decrypted_password('SendCloud', 'SendCloud', 'api_secret', raise_exception=False)
 		self.api_key, self.enabled = frappe.db.get_value('SendCloud', 'SendCloud', ['api_key', 'enabled'])
@@ -31,26 +45,28 @@ class SendCloudUtils():
 			return []
 
 		try:
-			url = 'https://panel.sendcloud.sc/api/v2/shipping_methods'
-			responses = requests.get(url, auth=(self.api_key, self.api_secret))
-			responses_dict = json.loads(responses.text)
-
-			if "error" in responses_dict:
-				error_message = responses_dict["error"]["message"]
-				frappe.throw(error_message, title=_("SendCloud"))
-
+			# Methods come from the synced catalog, no request is made to SendCloud
+			parcels = json.loads(shipment_parcel)
+			weight = max([flt(parcel.get('weight')) for parcel in parcels] or [0])
 			available_services = []
-			iso_code = delivery_address.country_code
-			for service in responses_dict['shipping_methods']:
-				countries = [country for country in service['countries'] if country['iso_2'] == iso_code]
-				if countries:
-					available_service = self.get_service_dict(service, countries[0], shipment_parcel)
-					available_services.append(available_service)
+			for service in get_shipping_methods(self, delivery_address.country_code, weight):
+				available_service = self.get_service_dict(service, service, shipment_parcel)
+				available_services.append(available_service)
 
 			return available_services
 		except Exception:
 			show_error_alert("fetching SendCloud prices")
 
+	def get_shipping_method_list(self):
+		url = 'https://panel.sendcloud.sc/api/v2/shipping_methods'
+		responses = transport.get(SENDCLOUD_PROVIDER, url, auth=(self.api_key, self.api_secret))
+		responses_dict = json.loads(responses.text)
+
+		if "error" in responses_dict:
+			error_message = responses_dict["error"]["message"]
+			frappe.throw(error_message, title=_("SendCloud"))
+		return responses_dict['shipping_methods']
+
 	def create_shipment(self, shipment, delivery_address, delivery_contact, service_info, shipment_parcel,
 		description_of_content, value_of_goods):
 		# Create a transaction at SendCloud
@@ -67,7 +83,7 @@ class SendCloudUtils():
 
 		try:
 			url = 'https://panel.sendcloud.sc/api/v2/parcels?errors=verbose'
-			response_data = requests.post(url, json=data, auth=(self.api_key, self.api_secret))
+			response_data = transport.post(SENDCLOUD_PROVIDER, url, json=data, auth=(self.api_key, self.api_secret))
 			response_data = json.loads(response_data.text)
 			if 'failed_parcels' in response_data:
 				error = response_data['failed_parcels'][0]['errors']
@@ -88,16 +104,9 @@ class SendCloudUtils():
 			show_error_alert("creating SendCloud Shipment")
 
 	def get_label(self, shipment_id):
-		# Retrieve shipment label from SendCloud
-		shipment_id_list = shipment_id.split(', ')
-		label_urls = []
-
+		# Retrieve shipment label from SendCloud, the labels of all parcels are fetched at once
 		try:
-			for ship_id in shipment_id_list:
-				shipment_label_response = \
-					requests.get('https://panel.sendcloud.sc/api/v2/labels/{id}'.format(id=ship_id), auth=(self.api_key, self.api_secret))
-				shipment_label = json.loads(shipment_label_response.text)
-				label_urls.append(shipment_label['label']['label_printer'])
+			label_urls = [label.url for label in self.get_parcel_labels(shipment_id)]
 			if len(label_urls):
 				return label_urls
 			else:
@@ -106,33 +115,61 @@ class SendCloudUtils():
 		except Exception:
 			show_error_alert("printing SendCloud Label")
 
+	def get_label_pdf(self, shipment_id):
+		# The labels of all parcels as one PDF, for the label store
+		parcel_labels = self.get_parcel_labels(shipment_id, download=True)
+		if parcel_labels:
+			return labels.merge_pdfs([label.content for label in parcel_labels])
+
+	def get_parcel_labels(self, shipment_id, download=False):
+		# Parcel labels are only requested from SendCloud, the threads don't connect to the database
+		parcel_labels = map_requests(partial(self.get_parcel_label, download=download), shipment_id.split(', '),
+			max_workers=labels.LABEL_CONCURRENCY)
+		return [label for label in parcel_labels if label]
+
+	def get_parcel_label(self, parcel_id, download=False):
+		shipment_label_response = \
+			transport.get(SENDCLOUD_PROVIDER, 'https://panel.sendcloud.sc/api/v2/labels/{id}'.format(id=parcel_id), auth=(self.api_key, self.api_secret))
+		shipment_label = json.loads(shipment_label_response.text)
+		label = frappe._dict(url=shipment_label['label']['label_printer'])
+		if download:
+			response = transport.get(SENDCLOUD_PROVIDER, label.url, auth=(self.api_key, self.api_secret))
+			response.raise_for_status()
+			label.content = response.content
+		return label
+
 	def get_tracking_data(self, shipment_id):
 		# return SendCloud tracking data
 		try:
-			shipment_id_list = shipment_id.split(', ')
-			awb_number, tracking_status, tracking_status_info, tracking_urls = [], [], [], []
-
-			for ship_id in shipment_id_list:
+			parcels = []
+			for ship_id in shipment_id.split(', '):
 				tracking_data_response = \
-					requests.get('https://panel.sendcloud.sc/api/v2/parcels/{id}'.format(id=ship_id),
+					transport.get(SENDCLOUD_PROVIDER, 'https://panel.sendcloud.sc/api/v2/parcels/{id}'.format(id=ship_id),
 						auth=(self.api_key, self.api_secret))
-				tracking_data = json.loads(tracking_data_response.text)
-				tracking_data_parcel = tracking_data['parcel']
-				tracking_data_parcel_status = tracking_data_parcel['status']['message']
-
-				tracking_urls.append(tracking_data_parcel['tracking_url'])
-				awb_number.append(tracking_data_parcel['tracking_number'])
-				tracking_status.append(tracking_data_parcel_status)
-				tracking_status_info.append(tracking_data_parcel_status)
-			return {
-				'awb_number': ', '.join(awb_number),
-				'tracking_status': ', '.join(tracking_status),
-				'tracking_status_info': ', '.join(tracking_status_info),
-				'tracking_url': ', '.join(tracking_urls)
-			}
+				parcels.append(json.loads(tracking_data_response.text)['parcel'])
+			return get_tracking_dict(parcels)
 		except Exception:
 			show_error_alert("updating SendCloud Shipment")
 
+	def get_tracking_data_batch(self, shipments):
+		# Track the parcels of many Shipments, up to 100 parcels per call. Returns {shipment_id: tracking data},
+		# Shipments with parcels SendCloud didn't return are left out.
+		parcel_ids = [ship_id for s in shipments for ship_id in s.shipment_id.split(', ')]
+		parcels = {}
+		for i in range(0, len(parcel_ids), 100):
+			response = transport.get(SENDCLOUD_PROVIDER, 'https://panel.sendcloud.sc/api/v2/parcels',
+				params={'ids': ','.join(parcel_ids[i:i + 100])}, auth=(self.api_key, self.api_secret))
+			response.raise_for_status()
+			for parcel in response.json().get('parcels', []):
+				parcels[str(parcel['id'])] = parcel
+
+		tracking_data = {}
+		for s in shipments:
+			shipment_parcels = [parcels.get(ship_id) for ship_id in s.shipment_id.split(', ')]
+			if all(shipment_parcels):
+				tracking_data[s.shipment_id] = get_tracking_dict(shipment_parcels)
+		return tracking_data
+
 	def total_parcel_price(self, parcel_price, shipment_parcel):
 		count = 0
 		for parcel in shipment_parcel:
@@ -188,4 +225,84 @@ class SendCloudUtils():
 			'external_reference': "{}-{}".format(shipment, index),
 			'weight': parcel.get('weight'),
 			'parcel_items': self.get_parcel_items(parcel, description_of_content, value_of_goods)
-		}
\ No newline at end of file
+		}
+
+def get_tracking_dict(parcels):
+	# Normalized tracking data of a Shipment's parcels, shared by the parcels API and the webhook
+	tracking_status = [parcel['status']['message'] for parcel in parcels]
+	return {
+		'awb_number': ', '.join([parcel['tracking_number'] for parcel in parcels]),
+		'tracking_status': ', '.join(tracking_status),
+		'tracking_status_info': ', '.join(tracking_status),
+		'tracking_url': ', '.join([parcel['tracking_url'] for parcel in parcels])
+	}
+
+def get_shipping_methods(sendcloud, iso_code, weight):
+	# Shipping methods to the country for parcels of the weight, with their price there.
+	# The catalog is synced on first use if the scheduler hasn't synced it yet, or again if the
+	# country's index was evicted from the cache while the catalog still lists the country.
+	country_index = get_country_index(iso_code)
+	if country_index is None:
+		cache = frappe.cache()
+		with cache.lock(cache.make_key(CATALOG_SYNCED_KEY + ':lock'), timeout=120):
+			country_index = get_country_index(iso_code)
+			if country_index is None:
+				sync_shipping_methods(sendcloud)
+				country_index = get_country_index(iso_code)
+
+	if not country_index:
+		return []
+	# Parcels without a weight are quoted like the lightest ones
+	band = max(bisect_right(country_index['boundaries'], weight) - 1, 0)
+	if band >= len(country_index['bands']):
+		return []
+	return country_index['bands'][band]
+
+def get_country_index(iso_code):
+	# The country's index, {} if the synced catalog doesn't ship there, None if the catalog must be synced
+	synced_countries = frappe.cache().get_value(CATALOG_SYNCED_KEY)
+	if synced_countries is None:
+		return None
+	if iso_code not in synced_countries:
+		return {}
+	return frappe.cache().get_value(CATALOG_COUNTRY_KEY.format(iso_code))
+
+def sync_shipping_methods(sendcloud=None):
+	# Download the shipping method catalog and index it by destination country and weight band.
+	# Each country's index holds the sorted weight boundaries of its methods, and for each band
+	# between two boundaries the methods that accept parcels of that weight.
+	from erpnext_shipping.erpnext_shipping.providers import get_provider, is_enabled
+
+	if not sendcloud:
+		if not is_enabled(SENDCLOUD_PROVIDER):
+			return
+		sendcloud = get_provider(SENDCLOUD_PROVIDER)
+
+	methods_by_country = {}
+	for service in sendcloud.get_shipping_method_list():
+		method = {
+			'id': service['id'],
+			'name': service['name'],
+			'carrier': service['carrier'],
+			'min_weight': flt(service.get('min_weight')),
+			'max_weight': flt(service.get('max_weight')) or float('inf')
+		}
+		for country in service['countries']:
+			methods_by_country.setdefault(country['iso_2'], []).append(dict(method, price=country['price']))
+
+	previous = frappe.cache().get_value(CATALOG_SYNCED_KEY) or []
+	for iso_code in set(previous) - set(methods_by_country):
+		frappe.cache().delete_value(CATALOG_COUNTRY_KEY.format(iso_code))
+	for iso_code, methods in methods_by_country.items():
+		# Kept past the catalog, so they are still there while it is synced again
+		frappe.cache().set_value(CATALOG_COUNTRY_KEY.format(iso_code), get_weight_band_index(methods),
+			expires_in_sec=2 * CATALOG_TTL)
+	frappe.cache().set_value(CATALOG_SYNCED_KEY, list(methods_by_country), expires_in_sec=CATALOG_TTL)
+
+def get_weight_band_index(methods):
+	boundaries = sorted({m['min_weight'] for m in methods} | {m['max_weight'] for m in methods})
+	bands = []
+	for lower in boundaries[:-1]:
+		bands.append([{key: m[key] for key in ('id', 'name', 'carrier', 'price')} for m in methods
+			if m['min_weight'] <= lower < m['max_weight']])
+	return {'boundaries': boundaries, 'bands': bands}
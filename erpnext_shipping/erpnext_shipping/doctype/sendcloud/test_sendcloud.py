@@ -3,8 +3,27 @@
 # See license.txt
 from __future__ import unicode_literals
 
-# import frappe
-import unittest
+from frappe.tests.utils import FrappeTestCase
+from erpnext_shipping.erpnext_shipping.doctype.sendcloud.sendcloud import get_weight_band_index
 
-class TestSendCloud(unittest.TestCase):
-	pass
+
+def get_method(id, min_weight, max_weight):
+	return {'id': id, 'name': 'Method {0}'.format(id), 'carrier': 'postnl', 'price': 5.0,
+		'min_weight': min_weight, 'max_weight': max_weight}
+
+
+class TestSendCloud(FrappeTestCase):
+	def test_weight_band_boundaries(self):
+		index = get_weight_band_index([get_method(1, 0, 2), get_method(2, 1, 5), get_method(3, 2, float('inf'))])
+		self.assertEqual(index['boundaries'], [0, 1, 2, 5, float('inf')])
+		self.assertEqual([[m['id'] for m in band] for band in index['bands']], [[1], [1, 2], [2, 3], [3]])
+
+	def test_method_excludes_its_max_weight(self):
+		index = get_weight_band_index([get_method(1, 0, 2), get_method(2, 2, 4)])
+		self.assertEqual(index['boundaries'], [0, 2, 4])
+		self.assertEqual([[m['id'] for m in band] for band in index['bands']], [[1], [2]])
+
+	def test_gap_between_methods_has_empty_band(self):
+		index = get_weight_band_index([get_method(1, 0, 1), get_method(2, 3, 5)])
+		self.assertEqual([[m['id'] for m in band] for band in index['bands']], [[1], [], [2]])
+		self.assertEqual(set(index['bands'][0][0]), {'id', 'name', 'carrier', 'price'})
@@ -2,24 +2,64 @@
 # For license information, please see license.txt
 
 import frappe
+from frappe import _
 from frappe.model.document import Document
-from erpnext_shipping.erpnext_shipping.doctype.shiprocket.shiprocket import SHIPROCKET_PROVIDER, ShiprocketUtils
-from frappe.utils.file_manager import save_url
+from functools import partial
+from erpnext_shipping.erpnext_shipping import labels
+from erpnext_shipping.erpnext_shipping.providers import PROVIDERS, call_provider
+from erpnext_shipping.erpnext_shipping.utils import run_concurrently
+
+# Manifest chunks generated at the same time
+MANIFEST_CONCURRENCY = 4
 
 class ShipmentManifest(Document):
 	def on_submit(self):
-		self.create_manifest()
+		# Large manifests take a while, they are generated in the background
+		frappe.enqueue('erpnext_shipping.erpnext_shipping.doctype.shipment_manifest.shipment_manifest.generate_manifest',
+			queue='long', timeout=3600, manifest=self.name, enqueue_after_commit=True)
+		frappe.msgprint(_('The manifest is being generated and will be attached to this document.'), alert=True)
 	
 	def create_manifest(self):
-		shipment_ids = []
-		manifest_url = None
-		for m in self.manifest_items:
-			shipment_ids.append(m.shipment_id)
-		if self.service_provider == SHIPROCKET_PROVIDER:
-			shiprocket = ShiprocketUtils()
-			manifest_url = shiprocket.get_manifest(shipment_ids)
-		
-		if manifest_url:
-			save_url(manifest_url, self.name, self.doctype, self.name, folder="Home", is_private=True)
+		# Providers with manifests implement `get_manifest(shipment_ids)`, returning the URL of a PDF, and
+		# `manifest_batch_size`, the most Shipments per manifest. Larger manifests are generated in chunks
+		# at the same time and merged into one attachment.
+		provider = PROVIDERS.get(self.service_provider)
+		if not provider or not hasattr(provider, 'get_manifest'):
+			frappe.throw(_('{0} does not support manifests').format(self.service_provider))
+
+		shipment_ids = [m.shipment_id for m in self.manifest_items]
+		batch_size = provider.manifest_batch_size
+		chunks = [shipment_ids[i:i + batch_size] for i in range(0, len(shipment_ids), batch_size)]
+		outcome = run_concurrently({i: partial(get_manifest_pdf, self.service_provider, chunk)
+			for i, chunk in enumerate(chunks)}, max_workers=MANIFEST_CONCURRENCY)
+
+		failed = [i for i in range(len(chunks)) if not outcome.results.get(i)]
+		if failed:
+			for error in outcome.errors.values():
+				frappe.log_error(title=_('Error while generating manifest {0}').format(self.name), message=repr(error))
+			frappe.throw(_('Could not generate the manifest for {0} of {1} Shipments').format(
+				sum(len(chunks[i]) for i in failed), len(shipment_ids)))
+
+		pdfs = [outcome.results[i] for i in range(len(chunks))]
+		return labels.save_pdf(self.doctype, self.name, '{0}.pdf'.format(self.name),
+			pdfs[0] if len(pdfs) == 1 else labels.merge_pdfs(pdfs))
 
+def get_manifest_pdf(service_provider, shipment_ids):
+	manifest_url = call_provider(service_provider, 'get_manifest', shipment_ids)
+	if manifest_url:
+		return labels.download_labels(service_provider, [manifest_url])
 
+def generate_manifest(manifest):
+	# Background job: generate and attach the manifest, failures are noted on the manifest
+	doc = frappe.get_doc('Shipment Manifest', manifest)
+	try:
+		doc.create_manifest()
+		frappe.db.commit()
+	except Exception:
+		frappe.db.rollback()
+		frappe.log_error(title=_('Error while generating manifest {0}').format(manifest))
+		messages = [frappe.parse_json(m).get('message') for m in frappe.local.message_log]
+		doc.add_comment('Comment', _('Manifest could not be generated: {0}').format(
+			messages[-1] if messages else _('see the Error Log')))
+		frappe.db.commit()
+	doc.notify_update()
@@ -0,0 +1,8 @@
+// Copyright (c) 2023, Frappe and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Shipping Rate Card', {
+	// refresh: function(frm) {
+
+	// }
+});
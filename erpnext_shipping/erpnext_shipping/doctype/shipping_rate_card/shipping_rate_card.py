@@ -0,0 +1,37 @@
+# Copyright (c) 2023, Frappe and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+from frappe.utils import flt
+
+class ShippingRateCard(Document):
+	def validate(self):
+		zones = {row.zone for row in self.zones}
+		slabs = set()
+		for row in self.slabs:
+			if row.zone not in zones:
+				frappe.throw(_('Row {0}: Zone {1} is not in the Zones table').format(row.idx, frappe.bold(row.zone)))
+			if flt(row.up_to_weight) <= 0:
+				frappe.throw(_('Row {0}: Up To Weight must be greater than 0').format(row.idx))
+			if (row.zone, flt(row.up_to_weight)) in slabs:
+				frappe.throw(_('Row {0}: Zone {1} already has a slab up to {2} kg').format(row.idx,
+					frappe.bold(row.zone), row.up_to_weight))
+			slabs.add((row.zone, flt(row.up_to_weight)))
+		if flt(self.volumetric_divisor) < 0:
+			frappe.throw(_('Volumetric Divisor cannot be negative'))
+
+	def on_update(self):
+		clear_rate_card_index()
+
+	def after_rename(self, old, new, merge=False):
+		clear_rate_card_index()
+
+	def on_trash(self):
+		clear_rate_card_index()
+
+def clear_rate_card_index():
+	from erpnext_shipping.erpnext_shipping.rate_cards import RATE_CARD_INDEX
+
+	frappe.cache().delete_value(RATE_CARD_INDEX)
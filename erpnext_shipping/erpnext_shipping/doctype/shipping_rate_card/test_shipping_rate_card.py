@@ -0,0 +1,54 @@
+# Copyright (c) 2023, Frappe and Contributors
+# See license.txt
+
+import frappe
+import numpy as np
+from frappe.tests.utils import FrappeTestCase
+from erpnext_shipping.erpnext_shipping.rate_cards import evaluate_rate_card, get_lane_arrays
+
+
+def get_card(**kwargs):
+	# Zone 0 within India, zone 1 to pincodes starting with 400 from anywhere
+	card = frappe._dict(volumetric_divisor=5000, cod_charge=30, cod_percent=2, additional_weight_step=0.5,
+		additional_weight_rate=20, from_prefixes=['IN', ''], to_prefixes=['IN', 'IN400'], row_zones=[0, 1],
+		slabs=[(np.array([0.5, 1, 2]), np.array([40, 60, 90])), (np.array([1]), np.array([100]))])
+	card.update(kwargs)
+	return card
+
+def get_lane(delivery_key, weight, pickup_key='IN110001', cod=False, value_of_goods=0, **parcel):
+	return {'pickup_key': pickup_key, 'delivery_key': delivery_key, 'cod': cod, 'value_of_goods': value_of_goods,
+		'parcels': [dict(parcel, weight=weight)]}
+
+
+class TestShippingRateCard(FrappeTestCase):
+	def evaluate(self, lanes, **kwargs):
+		return evaluate_rate_card(get_card(**kwargs), get_lane_arrays(lanes)).tolist()
+
+	def test_longest_prefix_picks_zone(self):
+		self.assertEqual(self.evaluate([get_lane('IN110020', 0.4), get_lane('IN400001', 0.4)]), [40, 100])
+
+	def test_slab_includes_its_upper_weight(self):
+		self.assertEqual(self.evaluate([get_lane('IN110020', 0.5), get_lane('IN110020', 0.51)]), [40, 60])
+
+	def test_volumetric_weight(self):
+		# Two 30x20x10 parcels weigh 1.2 kg each by volume
+		lane = get_lane('IN110020', 0.4, length=30, width=20, height=10, count=2)
+		self.assertEqual(self.evaluate([lane]), [110])
+		self.assertEqual(self.evaluate([lane], volumetric_divisor=0), [60])
+
+	def test_additional_weight_steps(self):
+		self.assertEqual(self.evaluate([get_lane('IN110020', 3.2), get_lane('IN110020', 2.5)]), [150, 110])
+
+	def test_no_additional_weight_rate_is_unpriceable(self):
+		prices = self.evaluate([get_lane('IN110020', 3.2)], additional_weight_rate=0)
+		self.assertTrue(np.isnan(prices[0]))
+
+	def test_cod_charge_is_higher_of_flat_and_percent(self):
+		prices = self.evaluate([get_lane('IN110020', 0.4, cod=True, value_of_goods=5000),
+			get_lane('IN110020', 0.4, cod=True, value_of_goods=500)])
+		self.assertEqual(prices, [140, 70])
+
+	def test_lane_without_zone_is_unpriceable(self):
+		prices = self.evaluate([get_lane('FR75001', 0.4, pickup_key='DE10115'), get_lane('IN110020', 0.4)])
+		self.assertTrue(np.isnan(prices[0]))
+		self.assertEqual(prices[1], 40)
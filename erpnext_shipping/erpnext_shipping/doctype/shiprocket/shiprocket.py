@@ -4,20 +4,45 @@
 import frappe
 import json
 from frappe import _, log_error
-from frappe.integrations.utils import make_get_request, make_post_request
 from frappe.model.document import Document
 from frappe.utils import data
-from frappe.utils.data import add_days, flt, get_datetime, now_datetime, time_diff_in_seconds, format_datetime
+from frappe.utils.data import cint, flt, get_datetime, format_datetime
 from frappe.utils.password import get_decrypted_password
+from erpnext_shipping.erpnext_shipping.auth_tokens import clear_auth_token, get_auth_token
+from erpnext_shipping.erpnext_shipping import labels, transport
 from erpnext_shipping.erpnext_shipping.utils import show_error_alert
 
 SHIPROCKET_PROVIDER = 'Shiprocket'
-class Shiprocket(Document):pass
+# Shiprocket tokens are valid for 10 days
+SHIPROCKET_TOKEN_VALIDITY = 10 * 24 * 60 * 60
+SHIPROCKET_TRACKING_URL = "https://shiprocket.co/tracking/{0}"
+
+PICKUP_LOCATIONS_KEY = 'erpnext_shipping:shiprocket_pickup_locations'
+PICKUP_LOCATION_LOCK = 'erpnext_shipping:shiprocket_pickup_location_lock:{0}'
+# The registry is refreshed hourly and whenever a booking uses a location missing from it
+PICKUP_LOCATIONS_TTL = 24 * 60 * 60
+
+class Shiprocket(Document):
+	def validate(self):
+		if self.has_value_changed('api_id') or self.has_value_changed('api_password'):
+			self.token = None
+			self.valid_upto = None
+
+	def on_update(self):
+		# Credentials may have changed, log in again on next use
+		clear_auth_token(SHIPROCKET_PROVIDER)
+		frappe.cache().delete_value(PICKUP_LOCATIONS_KEY)
 
 class ShiprocketUtils():
+	# Most AWBs Shiprocket tracks in one call
+	tracking_batch_size = 50
+	# Shipments per generated manifest, larger manifests are split
+	manifest_batch_size = 100
+
 	def __init__(self):
 		self.api_password = get_decrypted_password('Shiprocket', 'Shiprocket', 'api_password', raise_exception=False)
-		self.api_id, self.enabled = frappe.db.get_value('Shiprocket', 'Shiprocket', ['api_id', 'enabled'])
+		self.api_id, self.enabled, self.batch_pickups, self.pickup_batch_size = frappe.db.get_value('Shiprocket',
+			'Shiprocket', ['api_id', 'enabled', 'batch_pickups', 'pickup_batch_size'])
 		self.base_url = "https://apiv2.shiprocket.in/v1/external/"
 
 		if not self.enabled:
@@ -26,16 +51,10 @@ class ShiprocketUtils():
 		self.check_auth_token()
 		
 	def check_auth_token(self):
-		shiprocket_settings = frappe.get_doc("Shiprocket")
-		if shiprocket_settings.valid_upto:
-			if time_diff_in_seconds(shiprocket_settings.valid_upto, now_datetime()) < 150.0:
-				self.token = self.fetch_auth_token(shiprocket_settings)
-			else:
-				self.token = shiprocket_settings.token
-		else:
-			self.token = self.fetch_auth_token(shiprocket_settings)
+		# Tokens are shared by all workers through the cache, only one of them logs in
+		self.token = get_auth_token(SHIPROCKET_PROVIDER, self.fetch_auth_token, valid_for=SHIPROCKET_TOKEN_VALIDITY)
 	
-	def fetch_auth_token(self, shiprocket_settings):
+	def fetch_auth_token(self):
 		url = self.base_url+"auth/login"
 		headers = {
 			"Content-Type": "application/json"
@@ -44,36 +63,16 @@ class ShiprocketUtils():
 			"email": self.api_id,
 			"password": self.api_password
 		}
-		token_response = make_post_request(url, headers=headers, data=json.dumps(data))
-		token = token_response.get("token")
-		shiprocket_settings.token = token
-		shiprocket_settings.valid_upto = add_days(now_datetime(), 10)
-		shiprocket_settings.save(ignore_permissions=True)
-		frappe.db.commit()
-		return token
+		token_response = transport.make_post_request(SHIPROCKET_PROVIDER, url, headers=headers, data=json.dumps(data))
+		return token_response.get("token")
 
 	def get_available_services(self, pickup_pincode, delivery_pincode, weight, cod=False):
 		if not self.enabled or not self.api_id or not self.api_password:
 			frappe.throw(_('Please enable Shiprocket Integration'), title=_('Mandatory'))
 
-		url = self.base_url+"courier/serviceability/"
-		headers = {
-			"Content-Type": "application/json",
-			"Authorization": "Bearer {0}".format(self.token)
-		}
-		payload = dict(
-			pickup_postcode = pickup_pincode,
-			delivery_postcode = delivery_pincode,
-			weight = weight,
-			cod = cod
-		)
 		try:
 			available_services = []
-			response_data = make_get_request(
-				url=url,
-				headers=headers,
-				data=json.dumps(payload)
-			)
+			response_data = self.get_courier_companies(pickup_pincode, delivery_pincode, weight, cod)
 			if 'data' in response_data and "available_courier_companies" in response_data["data"]:
 				if len(response_data["data"]["available_courier_companies"]):
 					for response in response_data["data"]["available_courier_companies"]:
@@ -91,13 +90,47 @@ class ShiprocketUtils():
 			show_error_alert("fetching Shiprocket prices")
 
 		return []
+
+	def get_courier_companies(self, pickup_pincode, delivery_pincode, weight, cod=False):
+		# Ask Shiprocket which couriers serve the lane, the answer is kept in the serviceability index
+		from erpnext_shipping.erpnext_shipping.shiprocket_serviceability import record_serviceability
+
+		url = self.base_url+"courier/serviceability/"
+		headers = {
+			"Content-Type": "application/json",
+			"Authorization": "Bearer {0}".format(self.token)
+		}
+		payload = dict(
+			pickup_postcode = pickup_pincode,
+			delivery_postcode = delivery_pincode,
+			weight = weight,
+			cod = cod
+		)
+		response_data = transport.make_get_request(SHIPROCKET_PROVIDER,
+			url=url,
+			headers=headers,
+			data=json.dumps(payload)
+		)
+		if isinstance(response_data.get('data'), dict) and 'available_courier_companies' in response_data['data']:
+			record_serviceability(pickup_pincode, delivery_pincode, weight,
+				response_data['data']['available_courier_companies'], cod)
+		return response_data
 	
 	def create_shipment(self, shipment, pickup_address, delivery_address, shipment_parcel,
 		service_info, delivery_notes=None, delivery_contact=None, cod=False):
 		if not self.enabled or not self.api_id or not self.api_password:
 			return []
 
+		from erpnext_shipping.erpnext_shipping.shiprocket_serviceability import get_serviceable_couriers
+
 		parcel_list = self.get_parcel_list(json.loads(shipment_parcel))
+		# Refuse a courier Shiprocket recently left out when it offered others on the lane for this weight
+		couriers = get_serviceable_couriers(pickup_address.pincode, delivery_address.pincode, parcel_list.weight, cod)
+		if couriers and service_info.get("id") and cint(service_info.get("id")) not in couriers:
+			frappe.throw(_('{0} does not serve pincode {1} from pincode {2}, please fetch rates again.').format(
+				service_info.get("carrier"), delivery_address.pincode, pickup_address.pincode),
+				title=_('Not Serviceable'))
+
 		headers = {
 			"Content-Type": "application/json",
 			"Authorization": "Bearer {0}".format(self.token)
@@ -114,7 +147,7 @@ class ShiprocketUtils():
 			service_info=service_info)
 		url = self.base_url+"orders/create/adhoc"
 		try:
-			response_data = make_post_request(
+			response_data = transport.make_post_request(SHIPROCKET_PROVIDER,
 				url=url,
 				headers=headers,
 				data=json.dumps(payload)
@@ -127,18 +160,17 @@ class ShiprocketUtils():
 				}
 				if service_info.get("id", None):
 					awb_payload["courier_id"] = str(service_info.get("id"))
-				awb_response = make_post_request(awb_url, headers=headers, data=json.dumps(awb_payload))
+				awb_response = transport.make_post_request(SHIPROCKET_PROVIDER, awb_url, headers=headers, data=json.dumps(awb_payload))
 				if 'awb_assign_status' in awb_response:
 					if awb_response["awb_assign_status"] == 1:
 						awb_number = awb_response['response']['data']['awb_code']
-						pickup_url = self.base_url+"courier/generate/pickup"
-						pickup_payload= {
-							"shipment_id": [response_data.get("shipment_id")]
-						}
-						pickup_response = make_post_request(pickup_url, headers=headers, data=json.dumps(pickup_payload))
-						if not 'pickup_status' in pickup_response:
-							frappe.throw(_('An Error occurred while creating pickup: {0}')
-								.format(pickup_response['message']))
+						if self.batch_pickups:
+							# One pickup request per location and day, see shiprocket_pickups
+							from erpnext_shipping.erpnext_shipping.shiprocket_pickups import queue_pickup
+							queue_pickup(shipment, payload["pickup_location"],
+								frappe.db.get_value("Shipment", shipment, "pickup_date"), self.pickup_batch_size)
+						else:
+							self.generate_pickup([response_data.get("shipment_id")])
 				elif 'message' in awb_response:
 					frappe.throw(_('An Error occurred while generating AWB: {0}')
 						.format(awb_response['message']))
@@ -156,6 +188,22 @@ class ShiprocketUtils():
 		except Exception:
 			show_error_alert("creating Shiprocket Shipment")
 
+	def generate_pickup(self, shipment_ids):
+		# Request one pickup for many Shipments
+		pickup_url = self.base_url+"courier/generate/pickup"
+		headers = {
+			"Content-Type": "application/json",
+			"Authorization": "Bearer {0}".format(self.token)
+		}
+		pickup_payload = {
+			"shipment_id": shipment_ids
+		}
+		pickup_response = transport.make_post_request(SHIPROCKET_PROVIDER, pickup_url, headers=headers, data=json.dumps(pickup_payload))
+		if not 'pickup_status' in pickup_response:
+			frappe.throw(_('An Error occurred while creating pickup: {0}')
+				.format(pickup_response['message']))
+		return pickup_response
+
 	def get_label(self, shipment_id):
 		url = self.base_url+"courier/generate/label"
 		headers = {
@@ -166,7 +214,7 @@ class ShiprocketUtils():
 			"shipment_id": [shipment_id]
 		}
 		try:
-			response_data = make_post_request(
+			response_data = transport.make_post_request(SHIPROCKET_PROVIDER,
 				url=url,
 				headers=headers,
 				data=json.dumps(payload)
@@ -178,6 +226,12 @@ class ShiprocketUtils():
 					.format(response_data['message']))
 		except Exception:
 			show_error_alert("generating Shiprocket lable")
+
+	def get_label_pdf(self, shipment_id):
+		# The label as PDF bytes, for the label store. Shiprocket generates the label on each call.
+		label_url = self.get_label(shipment_id)
+		if label_url:
+			return labels.download_labels(SHIPROCKET_PROVIDER, [label_url])
 	
 	def get_manifest(self, shipment_ids):
 		url = self.base_url+"manifests/generate"
@@ -189,7 +243,7 @@ class ShiprocketUtils():
 			"shipment_id": shipment_ids
 		}
 		try:
-			response_data = make_post_request(
+			response_data = transport.make_post_request(SHIPROCKET_PROVIDER,
 				url=url,
 				headers=headers,
 				data=json.dumps(payload)
@@ -209,35 +263,40 @@ class ShiprocketUtils():
 			"Authorization": "Bearer {0}".format(self.token)
 		}
 		try:
-			response_data = make_get_request(
+			response_data = transport.make_get_request(SHIPROCKET_PROVIDER,
 				url=url,
 				headers=headers
 			)
 			if "tracking_data" in response_data:
-				tracking_status = "In Progress"
-				if response_data["tracking_data"]["shipment_track"][0]["current_status"] == "Delivered":
-					tracking_status = "Delivered"
-				pickup_at = None
-				delivered_at = None
-				if response_data["tracking_data"].get("shipment_track_activities", []):
-					for s in response_data["tracking_data"]["shipment_track_activities"]:
-						status = str(s["sr-status"])
-						if status == "42":
-							pickup_at = get_datetime(s["date"])
-							break
-				if tracking_status == "Delivered":
-					delivered_at = get_datetime(response_data["tracking_data"]["shipment_track"][0]["delivered_date"])
-				return {
-					'awb_number': response_data["tracking_data"]["shipment_track"][0]["awb_code"],
-					'tracking_status': tracking_status,
-					'tracking_status_info': response_data["tracking_data"]["shipment_track"][0]["current_status"],
-					'tracking_url': response_data["tracking_data"]["track_url"],
-					'pickup_at': pickup_at,
-					'delivered_at': delivered_at
-				}
+				return parse_tracking_data(response_data["tracking_data"])
 		
 		except Exception:
 			show_error_alert("track shipment")
+
+	def get_tracking_data_batch(self, shipments):
+		# Track up to `tracking_batch_size` Shipments by their AWBs in one call. Returns {shipment_id: tracking data},
+		# Shipments without an AWB are left out.
+		awbs = {s.awb_number: s.shipment_id for s in shipments if s.awb_number}
+		if not awbs:
+			return {}
+		url = self.base_url+"courier/track/awbs"
+		headers = {
+			"Content-Type": "application/json",
+			"Authorization": "Bearer {0}".format(self.token)
+		}
+		response_data = transport.make_post_request(SHIPROCKET_PROVIDER, url, headers=headers,
+			data=json.dumps({"awbs": list(awbs)}))
+
+		# Keyed by AWB, either as one object or as a list of single key objects
+		tracked = {}
+		for entry in (response_data if isinstance(response_data, list) else [response_data]):
+			tracked.update(entry)
+
+		tracking_data = {}
+		for awb, shipment_id in awbs.items():
+			data = (tracked.get(awb) or {}).get("tracking_data") or {}
+			tracking_data[shipment_id] = parse_tracking_data(data) if data.get("shipment_track") else None
+		return tracking_data
 	
 	def get_shipment_details(self, shipment_id):
 		shipment_details_url = self.base_url+"shipments/{0}".format(shipment_id)
@@ -246,13 +305,13 @@ class ShiprocketUtils():
 			"Authorization": "Bearer {0}".format(self.token)
 		}
 		try:
-			response_data = make_get_request(
+			response_data = transport.make_get_request(SHIPROCKET_PROVIDER,
 				url=shipment_details_url,
 				headers=headers
 			)
 			order_id = response_data["data"]["order_id"]
 			order_details_url = self.base_url+"orders/show/{0}".format(order_id)
-			return make_get_request(
+			return transport.make_get_request(SHIPROCKET_PROVIDER,
 				url=order_details_url,
 				headers=headers
 			)
@@ -275,14 +334,15 @@ class ShiprocketUtils():
 	def get_parcel_list(self, shipment_parcel):
 		parcel_list = frappe._dict(dict(weight = 0, height = 0, length = 0, width = 0))
 		for p in shipment_parcel:
-			parcel_list.weight += p["weight"]*p["count"]
 			parcel_list.height += p["height"]*p["count"]
 			parcel_list.length += p["length"]*p["count"]
 			parcel_list.width += p["width"]*p["count"]
+		parcel_list.weight = get_shipment_weight(shipment_parcel)
 		return parcel_list
 	
 	def generate_payload(self, shipment, pickup_address, delivery_address, delivery_contact,
 		parcel_list, delivery_notes, cod, service_info=None):
+		delivery_notes = parse_delivery_notes(delivery_notes)
 		order_items = self.get_order_items(delivery_notes)
 		payload = {
 			"order_id": shipment,
@@ -314,79 +374,187 @@ class ShiprocketUtils():
 		return payload
 	
 	def get_order_items(self, delivery_notes):
+		# Items of all Delivery Notes with their tax rates, loaded with one query per table
+		if not delivery_notes:
+			return []
+		fields = ["parent", "item_code", "item_name", "qty", "rate"]
+		has_hsn_code = frappe.get_meta("Delivery Note Item").has_field("gst_hsn_code")
+		if has_hsn_code:
+			fields.append("gst_hsn_code")
+		items = frappe.get_all("Delivery Note Item", filters={"parenttype": "Delivery Note", "parent": ["in", delivery_notes]},
+			fields=fields, order_by="parent asc, idx asc")
+		tax_rates = get_item_tax_rates(delivery_notes)
+
 		order_items = []
-		for dn in list(set(eval(delivery_notes))):
-			delivery_note = frappe.get_doc("Delivery Note", dn)
-			for item in delivery_note.items:
-				tax_rate = get_item_tax_amount_from_delivery_note(item.item_code, delivery_note)
-				order_item = {
-					"name": item.item_name,
-					"sku": item.item_code[:50],
-					"units": int(item.qty),
-					"selling_price": int(item.rate*(1+tax_rate/100)),
-					"tax": tax_rate,
-					"hsn": int(item.gst_hsn_code) if item.gst_hsn_code else ""
-				}
-				order_items.append(order_item)
+		for item in items:
+			tax_rate = int(tax_rates.get((item.parent, item.item_code), 0))
+			order_item = {
+				"name": item.item_name,
+				"sku": item.item_code[:50],
+				"units": int(item.qty),
+				"selling_price": int(item.rate*(1+tax_rate/100)),
+				"tax": tax_rate,
+				"hsn": int(item.gst_hsn_code) if has_hsn_code and item.gst_hsn_code else ""
+			}
+			order_items.append(order_item)
 		
 		return order_items
 	
 	def get_pickup_location(self, pickup_address):
+		# Shiprocket pickup locations are named after the address, truncated to 36 characters. They are
+		# resolved from the cached registry, Shiprocket is only asked about addresses it doesn't have yet.
+		location_name = pickup_address.name[:36]
+		try:
+			if location_name in get_pickup_locations(self):
+				return location_name
+
+			cache = frappe.cache()
+			with cache.lock(cache.make_key(PICKUP_LOCATION_LOCK.format(location_name)), timeout=60):
+				# The registry may be stale, or another worker may have just registered the address
+				if location_name in get_pickup_locations(self, refresh=True):
+					return location_name
+				self.add_pickup_location(location_name, pickup_address)
+				get_pickup_locations(self, refresh=True)
+				return location_name
+		except Exception:
+			show_error_alert("getting pickup location")
+
+	def get_pickup_location_list(self):
 		get_pickup_address_url = self.base_url+"settings/company/pickup"
 		headers = {
 			"Content-Type": "application/json",
 			"Authorization": "Bearer {0}".format(self.token)
 		}
-		try:
-			response_data = make_get_request(
-				url=get_pickup_address_url,
-				headers=headers
-			)
-			if not any(pickup_location["pickup_location"] == pickup_address.name[:36] for pickup_location in response_data["data"]["shipping_address"]):
-				add_pickup_address_url = self.base_url+"settings/company/addpickup"
-				add_pickup_address_payload= {
-					"pickup_location": pickup_address.name[:36],
-					"name": response_data["data"]["shipping_address"][0]["name"],
-					"email": response_data["data"]["shipping_address"][0]["email"],
-					"phone": response_data["data"]["shipping_address"][0]["phone"],
-					"address": "Address Line 1: {0}".format(pickup_address.address_line1),
-					"address_2": pickup_address.address_line2,
-					"city": pickup_address.city,
-					"state": pickup_address.state,
-					"country": pickup_address.country,
-					"pin_code": pickup_address.pincode
-				}
-				add_pickup_address_response = make_post_request(add_pickup_address_url, headers=headers, data=json.dumps(add_pickup_address_payload))
-				if 'success' in add_pickup_address_response:
-					return pickup_address.name[:36]
-				else:
-					frappe.throw(_('An Error occurred while adding pickup location: {0}')
-						.format(add_pickup_address_response['message']))
-			else:
-				return pickup_address.name[:36]
-		except Exception:
-			show_error_alert("getting pickup location")
+		response_data = transport.make_get_request(SHIPROCKET_PROVIDER,
+			url=get_pickup_address_url,
+			headers=headers
+		)
+		return response_data["data"]["shipping_address"]
+
+	def add_pickup_location(self, location_name, pickup_address):
+		# The contact of the first registered location is used for new ones
+		contact = next(iter(get_pickup_locations(self).values()))
+		add_pickup_address_url = self.base_url+"settings/company/addpickup"
+		headers = {
+			"Content-Type": "application/json",
+			"Authorization": "Bearer {0}".format(self.token)
+		}
+		add_pickup_address_payload= {
+			"pickup_location": location_name,
+			"name": contact["name"],
+			"email": contact["email"],
+			"phone": contact["phone"],
+			"address": "Address Line 1: {0}".format(pickup_address.address_line1),
+			"address_2": pickup_address.address_line2,
+			"city": pickup_address.city,
+			"state": pickup_address.state,
+			"country": pickup_address.country,
+			"pin_code": pickup_address.pincode
+		}
+		add_pickup_address_response = transport.make_post_request(SHIPROCKET_PROVIDER, add_pickup_address_url, headers=headers, data=json.dumps(add_pickup_address_payload))
+		if not 'success' in add_pickup_address_response:
+			frappe.throw(_('An Error occurred while adding pickup location: {0}')
+				.format(add_pickup_address_response['message']))
+
+def get_pickup_locations(shiprocket, refresh=False):
+	# {pickup location name: location} registered at Shiprocket, cached for all workers
+	locations = None if refresh else frappe.cache().get_value(PICKUP_LOCATIONS_KEY)
+	if locations is None:
+		locations = {location["pickup_location"]: location for location in shiprocket.get_pickup_location_list()}
+		frappe.cache().set_value(PICKUP_LOCATIONS_KEY, locations, expires_in_sec=PICKUP_LOCATIONS_TTL)
+	return locations
+
+def refresh_pickup_locations():
+	# Scheduled: keep the registry warm, so bookings don't have to fetch it
+	from erpnext_shipping.erpnext_shipping.providers import get_provider, is_enabled
+
+	if is_enabled(SHIPROCKET_PROVIDER):
+		get_pickup_locations(get_provider(SHIPROCKET_PROVIDER), refresh=True)
+
+def get_tracking_dict(awb_number, current_status, tracking_url, activities, delivered_date=None):
+	# Normalized tracking data, shared by the tracking API and the webhook
+	tracking_status = "In Progress"
+	if (current_status or "").upper() == "DELIVERED":
+		tracking_status = "Delivered"
+	pickup_at = None
+	delivered_at = None
+	for s in activities:
+		# 42 is Shiprocket's "Picked Up" status
+		if str(s.get("sr-status")) == "42":
+			pickup_at = get_datetime(s["date"])
+			break
+	if tracking_status == "Delivered" and delivered_date:
+		delivered_at = get_datetime(delivered_date)
+	return {
+		'awb_number': awb_number,
+		'tracking_status': tracking_status,
+		'tracking_status_info': current_status,
+		'tracking_url': tracking_url,
+		'pickup_at': pickup_at,
+		'delivered_at': delivered_at
+	}
+
+def parse_tracking_data(tracking_data):
+	# Map the tracking_data of Shiprocket's tracking APIs
+	shipment_track = tracking_data["shipment_track"][0]
+	return get_tracking_dict(
+		awb_number=shipment_track["awb_code"],
+		current_status=shipment_track["current_status"],
+		tracking_url=tracking_data.get("track_url"),
+		activities=tracking_data.get("shipment_track_activities") or [],
+		delivered_date=shipment_track.get("delivered_date")
+	)
+
+def parse_tracking_webhook(payload):
+	# Map a Shiprocket order status webhook to the data returned by get_tracking_data
+	scans = payload.get("scans") or []
+	delivered_date = None
+	if (payload.get("current_status") or "").upper() == "DELIVERED" and scans:
+		delivered_date = scans[-1].get("date")
+	return get_tracking_dict(
+		awb_number=payload.get("awb"),
+		current_status=payload.get("current_status"),
+		tracking_url=SHIPROCKET_TRACKING_URL.format(payload.get("awb")),
+		activities=scans,
+		delivered_date=delivered_date
+	)
+
+def get_shipment_weight(shipment_parcel):
+	# Weight of all parcels, the same for quoting, the serviceability index and booking
+	return sum(flt(p.get("weight")) * (cint(p.get("count")) or 1) for p in shipment_parcel)
+
+def parse_delivery_notes(delivery_notes):
+	# Delivery Note names, passed as a list or as its JSON
+	if isinstance(delivery_notes, str):
+		delivery_notes = json.loads(delivery_notes)
+	return list(set(delivery_notes or []))
 
 def get_invoice_number(delivery_notes):
-	for dn in list(set(eval(delivery_notes))):
-		si = frappe.db.get_value("Sales Invoice Item", filters={"delivery_note": dn, "docstatus": 1}, fieldname="parent", for_update=True)
-		if si:
-			return si
-	return None
-			
-def get_item_tax_amount_from_delivery_note(item, delivery_note):
-	tax_rate = 0.0
-	if delivery_note.total_taxes_and_charges:
-		for tax in delivery_note.taxes:
-			if getattr(tax, "category", None) and tax.category=="Valuation":
-				continue
-
-			item_tax_map = json.loads(tax.item_wise_tax_detail) if tax.item_wise_tax_detail else {}
-			if item_tax_map:
-				for item_code, tax_data in item_tax_map.items():
-					if item_code == item:
-						if isinstance(tax_data, list):
-							tax_rate += flt(tax_data[0])
-	return int(tax_rate)
+	if not delivery_notes:
+		return None
+	return frappe.db.get_value("Sales Invoice Item", filters={"delivery_note": ["in", delivery_notes], "docstatus": 1},
+		fieldname="parent", for_update=True)
+
+def get_item_tax_rates(delivery_notes):
+	# {(delivery note, item code): tax rate}, each tax row's item wise tax detail is parsed once
+	taxed = frappe.get_all("Delivery Note", filters={"name": ["in", delivery_notes], "total_taxes_and_charges": ["!=", 0]},
+		pluck="name")
+	if not taxed:
+		return {}
 
+	fields = ["parent", "item_wise_tax_detail"]
+	has_category = frappe.get_meta("Sales Taxes and Charges").has_field("category")
+	if has_category:
+		fields.append("category")
+	tax_rates = {}
+	for tax in frappe.get_all("Sales Taxes and Charges", filters={"parenttype": "Delivery Note", "parent": ["in", taxed]},
+		fields=fields):
+		if has_category and tax.category == "Valuation":
+			continue
 
+		item_tax_map = json.loads(tax.item_wise_tax_detail) if tax.item_wise_tax_detail else {}
+		for item_code, tax_data in item_tax_map.items():
+			if isinstance(tax_data, list):
+				key = (tax.parent, item_code)
+				tax_rates[key] = tax_rates.get(key, 0.0) + flt(tax_data[0])
+	return tax_rates
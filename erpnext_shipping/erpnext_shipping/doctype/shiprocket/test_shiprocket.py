@@ -1,9 +1,45 @@
 # Copyright (c) 2023, Frappe and Contributors
 # See license.txt
 
-# import frappe
+import numpy as np
 from frappe.tests.utils import FrappeTestCase
+from erpnext_shipping.erpnext_shipping.doctype.shiprocket.shiprocket import get_shipment_weight
+from erpnext_shipping.erpnext_shipping.shiprocket_serviceability import (get_index, get_lane_key, get_lanes,
+	merge_observations)
 
 
 class TestShiprocket(FrappeTestCase):
-	pass
+	def test_lane_key_has_weight_band(self):
+		self.assertEqual(get_lane_key('400 001', 0.4), 40000100)
+		self.assertEqual(get_lane_key('400001', 0.5), 40000100)
+		self.assertEqual(get_lane_key('400001', 3), 40000103)
+		self.assertEqual(get_lane_key('400001', 80), 40000107)
+		self.assertIsNone(get_lane_key('EC1A', 1))
+
+	def test_parcel_counts_set_the_weight_band(self):
+		# Three 0.4 kg parcels are quoted and booked in the 1-2 kg band
+		weight = get_shipment_weight([{'weight': 0.4, 'count': 3}])
+		self.assertAlmostEqual(weight, 1.2)
+		self.assertEqual(get_lane_key('400001', weight), 40000102)
+		self.assertEqual(get_shipment_weight([{'weight': 0.4, 'count': 0}, {'weight': 1}]), 1.4)
+
+	def test_index_round_trip(self):
+		lanes = {
+			40000100: ({10, 24}, {10}, 1000, True),
+			56000103: ({10}, {10}, 2000, False),
+			11000101: ({3, 10, 24, 51}, set(), 3000, True)
+		}
+		index = get_index(lanes)
+		self.assertEqual(index['couriers'], [3, 10, 24, 51])
+		self.assertEqual(index['lanes'].tolist(), [11000101, 40000100, 56000103])
+		self.assertEqual(index['served'].dtype, np.uint8)
+		self.assertEqual(get_lanes(index), lanes)
+
+	def test_cod_answer_keeps_couriers_without_cod(self):
+		lanes = merge_observations({}, [[40000100, [10, 24], [10], False, 1000]])
+		lanes = merge_observations(lanes, [[40000100, [10], [10], True, 2000]])
+		self.assertEqual(lanes[40000100], ({10, 24}, {10}, 2000, True))
+
+	def test_cod_answer_alone_is_incomplete(self):
+		lanes = merge_observations({}, [[40000100, [10], [10], True, 1000]])
+		self.assertEqual(lanes[40000100], ({10}, {10}, 1000, False))
@@ -0,0 +1,281 @@
+# Copyright (c) 2023, Frappe and contributors
+# For license information, please see license.txt
+
+import frappe
+import threading
+from io import BytesIO
+from frappe import _
+from erpnext_shipping.erpnext_shipping import transport
+from erpnext_shipping.erpnext_shipping.utils import check_shipment_permission, run_in_slices
+
+try:
+	from pypdf import PdfReader, PdfWriter
+	from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject, StreamObject
+except ImportError:
+	# Frappe versions before v15 ship PyPDF2
+	from PyPDF2 import PdfReader, PdfWriter
+	from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject, StreamObject
+
+# Labels downloaded at the same time
+LABEL_CONCURRENCY = 8
+# Held while a Shipment's label is downloaded and saved, so it is saved once
+STORE_LABEL_LOCK = 'erpnext_shipping:store_label:{0}'
+# Set while a label download is queued, further prints don't queue another one
+LABEL_QUEUED_KEY = 'erpnext_shipping:label_queued:{0}'
+LABEL_QUEUED_TTL = 10 * 60
+# Page attributes a page may inherit from its page tree, copied onto the page when merging
+INHERITED_PAGE_ATTRIBUTES = ['/Resources', '/MediaBox', '/CropBox', '/Rotate']
+
+def merge_pdfs(pdfs):
+	# Merge PDF documents, given as bytes, into one
+	writer = PdfWriter()
+	for pdf in pdfs:
+		for page in PdfReader(BytesIO(pdf)).pages:
+			writer.add_page(page)
+	output = BytesIO()
+	writer.write(output)
+	return output.getvalue()
+
+def save_label(shipment, file_name, content):
+	# Save a label as a private File attached to the Shipment, return its URL
+	return save_pdf('Shipment', shipment, file_name, content)
+
+def save_pdf(doctype, name, file_name, content):
+	file_doc = frappe.get_doc({
+		'doctype': 'File',
+		'file_name': file_name,
+		'content': content,
+		'is_private': 1,
+		'attached_to_doctype': doctype,
+		'attached_to_name': name
+	})
+	file_doc.save(ignore_permissions=True)
+	return file_doc.file_url
+
+def can_store_label(service_provider):
+	# Providers whose labels can be downloaded as a PDF, the others only hand out a label link
+	from erpnext_shipping.erpnext_shipping.providers import PROVIDERS
+
+	return hasattr(PROVIDERS.get(service_provider), 'get_label_pdf')
+
+def enqueue_label_prefetch(shipment, service_provider):
+	# Download the label once in the background, e.g. right after booking
+	if not can_store_label(service_provider):
+		return
+	queued_key = LABEL_QUEUED_KEY.format(shipment)
+	if frappe.cache().get_value(queued_key):
+		return
+	frappe.cache().set_value(queued_key, 1, expires_in_sec=LABEL_QUEUED_TTL)
+	frappe.enqueue('erpnext_shipping.erpnext_shipping.labels.store_label', shipment=shipment,
+		enqueue_after_commit=True)
+
+def store_label(shipment):
+	# Background job: download the Shipment's label from the carrier and keep it as a private File.
+	# Returns the URL of the stored label.
+	from erpnext_shipping.erpnext_shipping.providers import call_provider
+
+	cache = frappe.cache()
+	try:
+		with cache.lock(cache.make_key(STORE_LABEL_LOCK.format(shipment)), timeout=120):
+			# Read inside the lock, a label saved by a job that held it is committed by now.
+			# Locking reads see it even if this transaction started earlier.
+			service_provider, shipment_id, shipping_label = frappe.db.get_value('Shipment', shipment,
+				['service_provider', 'shipment_id', 'shipping_label'], for_update=True)
+			if shipping_label and frappe.db.get_value('File', {'file_url': shipping_label}, 'name', for_update=True):
+				return shipping_label
+			if not can_store_label(service_provider):
+				return None
+
+			content = call_provider(service_provider, 'get_label_pdf', shipment_id)
+			if not content:
+				return None
+			file_url = save_label(shipment, '{0}-label.pdf'.format(shipment), content)
+			frappe.db.set_value('Shipment', shipment, 'shipping_label', file_url, update_modified=False)
+			frappe.db.commit()
+			return file_url
+	finally:
+		# The next print may queue a download again
+		cache.delete_value(LABEL_QUEUED_KEY.format(shipment))
+
+def get_stored_label(service_provider, shipment_id):
+	# URL of the Shipment's stored label. Without one, a download is queued for the next print.
+	shipment = frappe.db.get_value('Shipment', {'service_provider': service_provider, 'shipment_id': shipment_id},
+		['name', 'shipping_label'], as_dict=True)
+	if not shipment:
+		return None
+	if shipment.shipping_label and frappe.db.exists('File', {'file_url': shipment.shipping_label}):
+		return shipment.shipping_label
+	enqueue_label_prefetch(shipment.name, service_provider)
+
+def download_labels(service_provider, urls, **kwargs):
+	# Download label PDFs from URLs, merged into one PDF
+	pdfs = []
+	for url in urls:
+		response = transport.get(service_provider, url, **kwargs)
+		response.raise_for_status()
+		pdfs.append(response.content)
+	return pdfs[0] if len(pdfs) == 1 else merge_pdfs(pdfs)
+
+@frappe.whitelist()
+def enqueue_bulk_labels(shipments):
+	# Merge the labels of many Shipments into one PDF in the background. Progress is published with
+	# `frappe.publish_progress`, the link to the PDF with the `bulk_labels` event.
+	shipments = frappe.parse_json(shipments)
+	check_shipment_permission(shipments, 'read', _('Not permitted to read Shipments'))
+
+	frappe.enqueue('erpnext_shipping.erpnext_shipping.labels.build_bulk_labels',
+		queue='long', timeout=3600, shipments=shipments)
+	frappe.msgprint(_('Preparing labels of {0} Shipments in the background.').format(len(shipments)),
+		alert=True)
+
+def build_bulk_labels(shipments):
+	# Fetch the labels that aren't stored yet, then merge all of them in the order given
+	stored = {s.name: s.shipping_label for s in frappe.get_all('Shipment',
+		filters={'name': ['in', shipments], 'docstatus': 1, 'shipment_id': ['is', 'set']},
+		fields=['name', 'shipping_label'])}
+	summary = frappe._dict(shipments=len(shipments), labels=0, failed=[s for s in shipments if s not in stored])
+
+	missing = [s for s in stored if not stored[s] or not frappe.db.exists('File', {'file_url': stored[s]})]
+	stored.update(fetch_labels(missing))
+	labels = [(s, stored[s]) for s in shipments if stored.get(s)]
+	summary.failed += [s for s in missing if not stored.get(s)]
+
+	if labels:
+		summary.file_url = write_merged_labels(labels)
+		summary.labels = len(labels)
+	frappe.publish_realtime('bulk_labels', summary, user=frappe.session.user)
+	return summary
+
+def fetch_labels(shipments):
+	# Store the labels of the Shipments, LABEL_CONCURRENCY at a time. Returns {shipment: file URL}.
+	lock = threading.Lock()
+	done = frappe._dict(count=0)
+
+	def fetch_slice(shipment_slice):
+		file_urls = {}
+		for shipment in shipment_slice:
+			try:
+				file_urls[shipment] = store_label(shipment)
+				frappe.db.commit()
+			except Exception:
+				frappe.db.rollback()
+				frappe.log_error(title=_('Error while fetching the label of Shipment {0}').format(shipment))
+			with lock:
+				done.count += 1
+				frappe.publish_progress(done.count * 100 / len(shipments), title=_('Fetching Shipping Labels'),
+					description=_('{0} of {1} labels fetched').format(done.count, len(shipments)))
+		return file_urls
+
+	outcome = run_in_slices(fetch_slice, shipments, LABEL_CONCURRENCY)
+	file_urls = {}
+	for result in outcome.results.values():
+		file_urls.update(result)
+	return file_urls
+
+def write_merged_labels(labels):
+	# Merge label files into a new private File. Each label's pages are written to the file as soon as
+	# its label is read, only the positions of the written objects are kept until the end.
+	file_name = 'shipping-labels-{0}.pdf'.format(frappe.generate_hash(length=10))
+	file_url = '/private/files/{0}'.format(file_name)
+	with open(get_label_path(file_url), 'wb') as output:
+		pdf = start_pdf(output)
+		for i, (shipment, label_url) in enumerate(labels):
+			with open(get_label_path(label_url), 'rb') as label:
+				append_pdf(pdf, PdfReader(label))
+			frappe.publish_progress((i + 1) * 100 / len(labels), title=_('Merging Shipping Labels'),
+				description=_('{0} of {1} labels merged').format(i + 1, len(labels)))
+		finish_pdf(pdf)
+
+	frappe.get_doc({
+		'doctype': 'File',
+		'file_name': file_name,
+		'file_url': file_url,
+		'is_private': 1
+	}).insert(ignore_permissions=True)
+	return file_url
+
+def start_pdf(output):
+	# A PDF written to `output` object by object. Object 1 is the page tree, object 2 the catalog,
+	# both written by `finish_pdf` once all pages are known.
+	output.write(b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+	return frappe._dict(output=output, offsets=[None, None], pages=[])
+
+def append_pdf(pdf, reader):
+	# Copy the pages of a document with everything they use, numbered after the objects written so far
+	ids, queue = {}, []
+
+	def get_reference(reference):
+		key = (reference.idnum, reference.generation)
+		if key not in ids:
+			pdf.offsets.append(None)
+			ids[key] = len(pdf.offsets)
+			queue.append((ids[key], reference))
+		return IndirectObject(ids[key], 0, None)
+
+	def copy(obj):
+		if isinstance(obj, IndirectObject):
+			return get_reference(obj)
+		if isinstance(obj, StreamObject):
+			stream = StreamObject()
+			stream._data = obj._data
+			stream.update({key: copy(value) for key, value in obj.items()})
+			return stream
+		if isinstance(obj, DictionaryObject):
+			return DictionaryObject({key: copy(value) for key, value in obj.items()})
+		if isinstance(obj, ArrayObject):
+			return ArrayObject([copy(value) for value in obj])
+		return obj
+
+	for page in reader.pages:
+		# Other objects referring to the page, e.g. annotations, get the copied page
+		reference = getattr(page, 'indirect_reference', None) or getattr(page, 'indirect_ref', None)
+		page = DictionaryObject(page.items())
+		for attribute in INHERITED_PAGE_ATTRIBUTES:
+			node = page
+			while attribute not in page and '/Parent' in node:
+				node = node['/Parent'].get_object()
+				if attribute in node:
+					page[NameObject(attribute)] = node.raw_get(attribute)
+		page.pop('/Parent', None)
+		pdf.offsets.append(None)
+		pdf.pages.append(len(pdf.offsets))
+		if reference:
+			ids[(reference.idnum, reference.generation)] = pdf.pages[-1]
+		page = copy(page)
+		page[NameObject('/Parent')] = IndirectObject(1, 0, None)
+		write_pdf_object(pdf, pdf.pages[-1], page)
+
+	while queue:
+		object_id, reference = queue.pop()
+		write_pdf_object(pdf, object_id, copy(reference.get_object()))
+
+def finish_pdf(pdf):
+	write_pdf_object(pdf, 1, DictionaryObject({
+		NameObject('/Type'): NameObject('/Pages'),
+		NameObject('/Kids'): ArrayObject([IndirectObject(page, 0, None) for page in pdf.pages]),
+		NameObject('/Count'): NumberObject(len(pdf.pages))
+	}))
+	write_pdf_object(pdf, 2, DictionaryObject({
+		NameObject('/Type'): NameObject('/Catalog'),
+		NameObject('/Pages'): IndirectObject(1, 0, None)
+	}))
+	xref = pdf.output.tell()
+	pdf.output.write('xref\n0 {0}\n0000000000 65535 f \n'.format(len(pdf.offsets) + 1).encode())
+	for offset in pdf.offsets:
+		pdf.output.write('{0:010d} 00000 n \n'.format(offset).encode())
+	pdf.output.write('trailer\n<< /Size {0} /Root 2 0 R >>\nstartxref\n{1}\n%%EOF\n'.format(
+		len(pdf.offsets) + 1, xref).encode())
+
+def write_pdf_object(pdf, object_id, obj):
+	pdf.offsets[object_id - 1] = pdf.output.tell()
+	pdf.output.write('{0} 0 obj\n'.format(object_id).encode())
+	if obj is None:
+		pdf.output.write(b'null')
+	else:
+		obj.write_to_stream(pdf.output, None)
+	pdf.output.write(b'\nendobj\n')
+
+def get_label_path(file_url):
+	if file_url.startswith('/private/'):
+		return frappe.get_site_path(*file_url.strip('/').split('/'))
+	return frappe.get_site_path('public', *file_url.strip('/').split('/'))
@@ -0,0 +1,4 @@
+from frappe.custom.doctype.custom_field.custom_field import create_custom_field
+def execute():
+	create_custom_field("Shipment", dict(fieldname="shipping_label", label="Shipping Label", fieldtype="Attach",
+		insert_after="awb_number", read_only=1, allow_on_submit=1, print_hide=1, no_copy=1))
@@ -0,0 +1,11 @@
+from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
+def execute():
+	create_custom_fields({
+		"Shipment": [
+			dict(fieldname="pickup_status", label="Pickup Status", fieldtype="Select",
+				options="\nPending\nScheduled\nFailed", insert_after="shipping_label", read_only=1,
+				allow_on_submit=1, print_hide=1, no_copy=1, in_standard_filter=1),
+			dict(fieldname="pickup_location", label="Pickup Location", fieldtype="Data",
+				insert_after="pickup_status", read_only=1, allow_on_submit=1, print_hide=1, no_copy=1)
+		]
+	})
@@ -0,0 +1,14 @@
+from frappe.custom.doctype.custom_field.custom_field import create_custom_field
+def execute():
+	shipment_df = [
+		dict(fieldname="rate_quote_section", label="Rate Quote", fieldtype="Section Break", insert_after="delivered_at", collapsible=1),
+		dict(fieldname="quoted_service_provider", label="Quoted Service Provider", fieldtype="Data", insert_after="rate_quote_section", read_only=1, allow_on_submit=1, print_hide=1),
+		dict(fieldname="quoted_carrier", label="Quoted Carrier", fieldtype="Data", insert_after="quoted_service_provider", read_only=1, allow_on_submit=1, print_hide=1),
+		dict(fieldname="quoted_carrier_service", label="Quoted Carrier Service", fieldtype="Data", insert_after="quoted_carrier", read_only=1, allow_on_submit=1, print_hide=1),
+		dict(fieldname="rate_quote_column_break", fieldtype="Column Break", insert_after="quoted_carrier_service"),
+		dict(fieldname="quoted_amount", label="Quoted Amount", fieldtype="Currency", insert_after="rate_quote_column_break", read_only=1, allow_on_submit=1, print_hide=1),
+		dict(fieldname="quoted_at", label="Quoted At", fieldtype="Datetime", insert_after="quoted_amount", read_only=1, allow_on_submit=1, print_hide=1),
+		dict(fieldname="quoted_service_data", label="Quoted Service Data", fieldtype="Code", options="JSON", insert_after="quoted_at", hidden=1, read_only=1, allow_on_submit=1, print_hide=1)
+	]
+	for sdf in shipment_df:
+		create_custom_field("Shipment", sdf)
@@ -0,0 +1,4 @@
+from frappe.custom.doctype.custom_field.custom_field import create_custom_field
+def execute():
+	create_custom_field("Shipment", dict(fieldname="next_tracking_poll", label="Next Tracking Poll", fieldtype="Datetime",
+		insert_after="delivered_at", hidden=1, read_only=1, allow_on_submit=1, print_hide=1, no_copy=1, search_index=1))
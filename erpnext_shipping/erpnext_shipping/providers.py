@@ -0,0 +1,76 @@
+# Copyright (c) 2023, Frappe and contributors
+# For license information, please see license.txt
+
+import frappe
+import threading
+from erpnext_shipping.erpnext_shipping.doctype.letmeship.letmeship import LETMESHIP_PROVIDER, LetMeShipUtils
+from erpnext_shipping.erpnext_shipping.doctype.packlink.packlink import PACKLINK_PROVIDER, PackLinkUtils
+from erpnext_shipping.erpnext_shipping.doctype.sendcloud.sendcloud import SENDCLOUD_PROVIDER, SendCloudUtils
+from erpnext_shipping.erpnext_shipping.doctype.shiprocket.shiprocket import SHIPROCKET_PROVIDER, ShiprocketUtils
+from erpnext_shipping.erpnext_shipping.doctype.dunzo.dunzo import DUNZO_PROVIDER, DunzoUtils
+
+# Client class per provider, each provider's settings doctype is named after it
+PROVIDERS = {
+	LETMESHIP_PROVIDER: LetMeShipUtils,
+	PACKLINK_PROVIDER: PackLinkUtils,
+	SENDCLOUD_PROVIDER: SendCloudUtils,
+	SHIPROCKET_PROVIDER: ShiprocketUtils,
+	DUNZO_PROVIDER: DunzoUtils,
+}
+
+# Arguments each provider's `create_shipment` takes, picked from the booking context
+CREATE_SHIPMENT_ARGS = {
+	LETMESHIP_PROVIDER: ['pickup_address', 'delivery_address', 'shipment_parcel', 'description_of_content',
+		'pickup_date', 'value_of_goods', 'pickup_contact', 'delivery_contact', 'service_info'],
+	PACKLINK_PROVIDER: ['pickup_address', 'delivery_address', 'shipment_parcel', 'description_of_content',
+		'pickup_date', 'value_of_goods', 'pickup_contact', 'delivery_contact', 'service_info'],
+	SENDCLOUD_PROVIDER: ['shipment', 'delivery_address', 'shipment_parcel', 'description_of_content',
+		'value_of_goods', 'delivery_contact', 'service_info'],
+	SHIPROCKET_PROVIDER: ['shipment', 'pickup_address', 'delivery_address', 'shipment_parcel', 'service_info',
+		'delivery_notes', 'delivery_contact'],
+	DUNZO_PROVIDER: ['shipment', 'pickup_address', 'delivery_address', 'delivery_contact', 'pickup_contact'],
+}
+
+# One client per provider per site, kept until the provider's settings are saved
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_provider_settings(service_provider):
+	# Settings are cached by Frappe and dropped from the cache whenever they are saved
+	return frappe.get_cached_doc(service_provider, service_provider)
+
+def is_enabled(service_provider):
+	return service_provider in PROVIDERS and bool(get_provider_settings(service_provider).enabled)
+
+def get_enabled_providers():
+	return [service_provider for service_provider in PROVIDERS if is_enabled(service_provider)]
+
+def get_provider(service_provider):
+	# Return the cached client for the provider, a new one is built after its settings change.
+	# Building a client for a disabled provider raises, just like instantiating it directly.
+	settings_version = str(get_provider_settings(service_provider).modified)
+	key = (frappe.local.site, service_provider)
+	cached = _clients.get(key)
+	if cached and cached[0] == settings_version:
+		client = cached[1]
+	else:
+		with _clients_lock:
+			client = PROVIDERS[service_provider]()
+			_clients[key] = (settings_version, client)
+
+	if hasattr(client, 'check_auth_token'):
+		client.check_auth_token()
+	return client
+
+def call_provider(service_provider, method, *args, **kwargs):
+	# Dispatch an operation to the provider's client, None if the provider doesn't support it
+	if service_provider not in PROVIDERS or not hasattr(PROVIDERS[service_provider], method):
+		return None
+	return getattr(get_provider(service_provider), method)(*args, **kwargs)
+
+def create_shipment(service_provider, **context):
+	# Book with the provider, passing it only the arguments it takes
+	if service_provider not in CREATE_SHIPMENT_ARGS:
+		return None
+	kwargs = {arg: context.get(arg) for arg in CREATE_SHIPMENT_ARGS[service_provider]}
+	return get_provider(service_provider).create_shipment(**kwargs)
@@ -0,0 +1,119 @@
+# Copyright (c) 2023, Frappe and contributors
+# For license information, please see license.txt
+
+import frappe
+import hashlib
+import json
+import time
+from six import string_types
+from frappe.utils import cint, flt
+
+# Seconds a quote stays valid, override per provider with `shipping_rate_cache_ttl` in site_config.json
+DEFAULT_RATE_CACHE_TTL = {
+	'LetMeShip': 15 * 60,
+	'Packlink': 15 * 60,
+	'SendCloud': 60 * 60,
+	'Shiprocket': 10 * 60,
+	'Dunzo': 60,
+}
+# Upper bound on cached quotes, the least recently used ones are evicted first
+DEFAULT_RATE_CACHE_SIZE = 5000
+
+RATE_CACHE_KEY = 'erpnext_shipping:rate_quote:{0}:{1}'
+RATE_CACHE_INDEX = 'erpnext_shipping:rate_quote_index'
+RATE_CACHE_STATS = 'erpnext_shipping:rate_quote_stats:{0}:{1}'
+
+def get_rate_signature(pickup_address, delivery_address, shipment_parcel, pickup_date, cod=False, **extra):
+	# Canonical lane + parcel signature, independent of parcel order and address formatting.
+	# `extra` holds whatever else a provider prices on (goods value, GPS, COD amount).
+	if isinstance(shipment_parcel, string_types):
+		shipment_parcel = json.loads(shipment_parcel)
+
+	parcels = sorted(
+		(flt(p.get('length')), flt(p.get('width')), flt(p.get('height')), flt(p.get('weight')), cint(p.get('count')))
+		for p in shipment_parcel
+	)
+	signature = {
+		'lane': [get_address_signature(pickup_address), get_address_signature(delivery_address)],
+		'parcels': parcels,
+		'pickup_date': str(pickup_date or ''),
+		'cod': cint(cod),
+		'extra': extra,
+	}
+	return hashlib.sha1(json.dumps(signature, sort_keys=True, default=str).encode()).hexdigest()
+
+def get_address_signature(address):
+	return [
+		(address.country_code or '').upper(),
+		(address.pincode or '').replace(' ', '').upper(),
+		(address.city or '').strip().lower(),
+	]
+
+def get_rate_cache_ttl(service_provider):
+	ttl = frappe.conf.get('shipping_rate_cache_ttl') or {}
+	return cint(ttl.get(service_provider, DEFAULT_RATE_CACHE_TTL.get(service_provider, 0)))
+
+def get_cached_rates(service_provider, signature):
+	# Return cached rates or None, counting the hit or miss
+	if not signature or not get_rate_cache_ttl(service_provider):
+		return None
+
+	key = RATE_CACHE_KEY.format(service_provider, signature)
+	rates = frappe.cache().get_value(key)
+	count_lookup(service_provider, hit=rates is not None)
+	if rates is not None:
+		frappe.cache().zadd(frappe.cache().make_key(RATE_CACHE_INDEX), {key: time.time()})
+	return rates
+
+def set_cached_rates(service_provider, signature, rates):
+	# Empty results are usually errors swallowed by the provider, never cache them
+	ttl = get_rate_cache_ttl(service_provider)
+	if not signature or not ttl or not rates:
+		return
+
+	key = RATE_CACHE_KEY.format(service_provider, signature)
+	frappe.cache().set_value(key, rates, expires_in_sec=ttl)
+	index = frappe.cache().make_key(RATE_CACHE_INDEX)
+	frappe.cache().zadd(index, {key: time.time()})
+	evict_rates(index)
+
+def evict_rates(index):
+	size = cint(frappe.conf.get('shipping_rate_cache_size')) or DEFAULT_RATE_CACHE_SIZE
+	overflow = frappe.cache().zcard(index) - size
+	if overflow > 0:
+		evicted = [frappe.safe_decode(key) for key, score in frappe.cache().zpopmin(index, overflow)]
+		frappe.cache().delete_value(evicted)
+
+def count_lookup(service_provider, hit):
+	frappe.cache().incr(get_stats_key(service_provider, 'hits' if hit else 'misses'))
+
+def get_stats_key(service_provider, counter):
+	return frappe.cache().make_key(RATE_CACHE_STATS.format(service_provider, counter))
+
+def clear_rate_cache():
+	index = frappe.cache().make_key(RATE_CACHE_INDEX)
+	keys = [frappe.safe_decode(key) for key in frappe.cache().zrange(index, 0, -1)]
+	if keys:
+		frappe.cache().delete_value(keys)
+	stats_keys = [get_stats_key(service_provider, counter)
+		for service_provider in DEFAULT_RATE_CACHE_TTL for counter in ('hits', 'misses')]
+	frappe.cache().delete(index, *stats_keys)
+
+@frappe.whitelist()
+def get_rate_cache_stats():
+	# Hit/miss counters per provider since the cache was last cleared
+	frappe.only_for('System Manager')
+	stats = {}
+	for service_provider in DEFAULT_RATE_CACHE_TTL:
+		hits = cint(frappe.cache().get(get_stats_key(service_provider, 'hits')))
+		misses = cint(frappe.cache().get(get_stats_key(service_provider, 'misses')))
+		stats[service_provider] = frappe._dict(
+			hits=hits,
+			misses=misses,
+			hit_rate=flt(hits * 100.0 / (hits + misses), 2) if hits + misses else 0
+		)
+
+	return {
+		'size': frappe.cache().zcard(frappe.cache().make_key(RATE_CACHE_INDEX)),
+		'providers': stats,
+	}
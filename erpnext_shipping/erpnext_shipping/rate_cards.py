@@ -0,0 +1,174 @@
+# Copyright (c) 2023, Frappe and contributors
+# For license information, please see license.txt
+
+import frappe
+import json
+import numpy as np
+from frappe import _
+from frappe.utils import cint, flt
+from erpnext_shipping.erpnext_shipping.utils import check_shipment_permission, get_address, get_shipment_parcels
+
+# Enabled Shipping Rate Cards compiled to arrays, rebuilt after a card is saved
+RATE_CARD_INDEX = 'erpnext_shipping:rate_card_index'
+
+SHIPMENT_ESTIMATE_FIELDS = ['name', 'pickup_address_name', 'delivery_address_name', 'value_of_goods']
+
+def get_rate_card_index():
+	return frappe.cache().get_value(RATE_CARD_INDEX, generator=build_rate_card_index)
+
+def build_rate_card_index():
+	# Each card's zone rows as prefix lists, and per zone its slab weights and rates as sorted arrays
+	cards = frappe.get_all('Shipping Rate Card', filters={'enabled': 1}, fields=['name', 'service_provider',
+		'carrier', 'service_name', 'currency', 'volumetric_divisor', 'cod_charge', 'cod_percent',
+		'additional_weight_step', 'additional_weight_rate'])
+	rows = {}
+	for doctype, fields in (('Shipping Rate Card Zone', ['from_prefix', 'to_prefix', 'zone']),
+		('Shipping Rate Card Slab', ['zone', 'up_to_weight', 'rate'])):
+		for row in frappe.get_all(doctype, filters={'parent': ['in', [c.name for c in cards]],
+			'parenttype': 'Shipping Rate Card'}, fields=['parent'] + fields, order_by='idx'):
+			rows.setdefault((doctype, row.parent), []).append(row)
+
+	index = []
+	for card in cards:
+		zones = rows.get(('Shipping Rate Card Zone', card.name), [])
+		zone_names = list(dict.fromkeys(row.zone for row in zones))
+		slabs = sorted(rows.get(('Shipping Rate Card Slab', card.name), []), key=lambda row: flt(row.up_to_weight))
+		card.from_prefixes = [get_lane_key(row.from_prefix) for row in zones]
+		card.to_prefixes = [get_lane_key(row.to_prefix) for row in zones]
+		card.row_zones = [zone_names.index(row.zone) for row in zones]
+		card.slabs = []
+		for zone in zone_names:
+			zone_slabs = [row for row in slabs if row.zone == zone]
+			card.slabs.append((np.array([flt(row.up_to_weight) for row in zone_slabs]),
+				np.array([flt(row.rate) for row in zone_slabs])))
+		index.append(card)
+	return index
+
+def get_lane_key(country_code, pincode=None):
+	# Country code followed by the postal code, e.g. IN110001. Zone prefixes are matched against it.
+	return '{0}{1}'.format(country_code or '', pincode or '').replace(' ', '').upper()
+
+def estimate_rates(pickup_address, delivery_address, shipment_parcel, cod=False, value_of_goods=0,
+	service_providers=None):
+	# Rates of one shipment from the Shipping Rate Cards, shaped like a provider's `get_available_services`
+	return estimate_lane_rates([{
+		'pickup_key': get_lane_key(pickup_address.country_code, pickup_address.pincode),
+		'delivery_key': get_lane_key(delivery_address.country_code, delivery_address.pincode),
+		'parcels': json.loads(shipment_parcel) if isinstance(shipment_parcel, str) else shipment_parcel,
+		'cod': cod,
+		'value_of_goods': value_of_goods
+	}], service_providers)[0]
+
+def estimate_lane_rates(lanes, service_providers=None):
+	# Rates of many shipments at once, each card is evaluated over all of them with array operations.
+	# `lanes` holds {pickup_key, delivery_key, parcels, cod, value_of_goods}, one list of rates is
+	# returned per lane, cheapest first.
+	rates = [[] for lane in lanes]
+	cards = [card for card in get_rate_card_index()
+		if service_providers is None or card.service_provider in service_providers]
+	if not lanes or not cards:
+		return rates
+
+	arrays = get_lane_arrays(lanes)
+	for card in cards:
+		prices = evaluate_rate_card(card, arrays)
+		for i in np.flatnonzero(~np.isnan(prices)):
+			rates[i].append(get_service_dict(card, prices[i]))
+
+	for lane_rates in rates:
+		lane_rates.sort(key=lambda rate: rate['total_price'])
+	return rates
+
+def get_lane_arrays(lanes):
+	# One entry per lane, and one per parcel row with the index of its lane
+	parcels = [(i, parcel) for i, lane in enumerate(lanes) for parcel in lane['parcels']]
+	return frappe._dict(
+		count=len(lanes),
+		pickup_keys=np.array([lane['pickup_key'] for lane in lanes], dtype=str),
+		delivery_keys=np.array([lane['delivery_key'] for lane in lanes], dtype=str),
+		cod=np.array([bool(cint(lane.get('cod'))) for lane in lanes]),
+		value_of_goods=np.array([flt(lane.get('value_of_goods')) for lane in lanes]),
+		parcel_lane=np.array([i for i, parcel in parcels], dtype=int),
+		parcel_volume=np.array([flt(p.get('length')) * flt(p.get('width')) * flt(p.get('height')) for i, p in parcels]),
+		parcel_weight=np.array([flt(p.get('weight')) for i, p in parcels]),
+		parcel_count=np.array([cint(p.get('count')) or 1 for i, p in parcels])
+	)
+
+def evaluate_rate_card(card, arrays):
+	# Price of every lane on the card, NaN where the card has no zone or slab for it
+	zone = np.full(arrays.count, -1)
+	score = np.full(arrays.count, -1)
+	for from_prefix, to_prefix, row_zone in zip(card.from_prefixes, card.to_prefixes, card.row_zones):
+		row_score = len(from_prefix) + len(to_prefix)
+		better = (np.char.startswith(arrays.pickup_keys, from_prefix)
+			& np.char.startswith(arrays.delivery_keys, to_prefix) & (row_score > score))
+		zone[better] = row_zone
+		score[better] = row_score
+
+	# Parcels are charged by the higher of their actual and volumetric weight
+	parcel_weight = arrays.parcel_weight
+	if flt(card.volumetric_divisor):
+		parcel_weight = np.maximum(parcel_weight, arrays.parcel_volume / flt(card.volumetric_divisor))
+	weight = np.bincount(arrays.parcel_lane, weights=parcel_weight * arrays.parcel_count, minlength=arrays.count)
+
+	prices = np.full(arrays.count, np.nan)
+	for z, (slab_weights, slab_rates) in enumerate(card.slabs):
+		in_zone = np.flatnonzero(zone == z)
+		if not len(in_zone) or not len(slab_weights):
+			continue
+		zone_weight = weight[in_zone]
+		slab = np.searchsorted(slab_weights, zone_weight, side='left')
+		heavier = slab >= len(slab_weights)
+		zone_prices = slab_rates[np.minimum(slab, len(slab_weights) - 1)]
+		if flt(card.additional_weight_step) and flt(card.additional_weight_rate):
+			steps = np.ceil((zone_weight - slab_weights[-1]) / flt(card.additional_weight_step))
+			zone_prices = np.where(heavier, slab_rates[-1] + steps * flt(card.additional_weight_rate), zone_prices)
+		else:
+			zone_prices = np.where(heavier, np.nan, zone_prices)
+		prices[in_zone] = zone_prices
+
+	cod_charge = np.maximum(flt(card.cod_charge), arrays.value_of_goods * flt(card.cod_percent) / 100)
+	return prices + np.where(arrays.cod, cod_charge, 0)
+
+def get_service_dict(card, price):
+	available_service = frappe._dict()
+	available_service.service_provider = card.service_provider
+	available_service.carrier = card.carrier
+	available_service.carrier_name = card.carrier
+	available_service.service_name = card.service_name or card.carrier
+	available_service.is_preferred = 0
+	available_service.total_price = flt(price, 2)
+	available_service.currency = card.currency
+	available_service.rate_card = card.name
+	available_service.is_estimate = 1
+	return available_service
+
+@frappe.whitelist()
+def estimate_shipment_rates(shipments, cod=False):
+	# Estimated rates of many Shipments from the Shipping Rate Cards, no carrier is called.
+	# Returns {shipment: [rate, ...]}, cheapest first.
+	shipments = frappe.parse_json(shipments)
+	check_shipment_permission(shipments, 'read', _('Not permitted to read Shipments'))
+
+	parcels = get_shipment_parcels(shipments)
+
+	addresses, names, lanes = {}, [], []
+	for shipment in frappe.get_all('Shipment', filters={'name': ['in', shipments]}, fields=SHIPMENT_ESTIMATE_FIELDS):
+		try:
+			for address_name in (shipment.pickup_address_name, shipment.delivery_address_name):
+				if address_name not in addresses:
+					address = get_address(address_name)
+					addresses[address_name] = get_lane_key(address.country_code, address.pincode)
+		except Exception:
+			frappe.clear_messages()
+			continue
+
+		names.append(shipment.name)
+		lanes.append({
+			'pickup_key': addresses[shipment.pickup_address_name],
+			'delivery_key': addresses[shipment.delivery_address_name],
+			'parcels': parcels.get(shipment.name, []),
+			'cod': cod,
+			'value_of_goods': shipment.value_of_goods
+		})
+	return dict(zip(names, estimate_lane_rates(lanes)))
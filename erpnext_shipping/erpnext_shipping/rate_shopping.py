@@ -0,0 +1,151 @@
+# Copyright (c) 2023, Frappe and contributors
+# For license information, please see license.txt
+
+import frappe
+import json
+import threading
+from frappe import _
+from frappe.utils import cint, now_datetime
+from erpnext_shipping.erpnext_shipping.rate_cache import get_rate_signature
+from erpnext_shipping.erpnext_shipping.rates import get_rate_jobs, get_rate_quotes
+from erpnext_shipping.erpnext_shipping.utils import (check_shipment_permission, get_address, get_shipment_parcels,
+	run_in_slices)
+
+# Number of lanes quoted at the same time, each lane queries all enabled providers at once.
+# Override with `shipping_bulk_rate_concurrency` in site_config.json
+DEFAULT_BULK_RATE_CONCURRENCY = 4
+
+SHIPMENT_RATE_FIELDS = ['name', 'pickup_from_type', 'delivery_to_type', 'pickup_address_name',
+	'delivery_address_name', 'pickup_contact_person', 'pickup_contact_name', 'delivery_contact_name',
+	'description_of_content', 'pickup_date', 'value_of_goods']
+
+@frappe.whitelist()
+def enqueue_bulk_rate_shopping(shipments):
+	# Quote many Shipments in the background, the cheapest rate is written back to each Shipment.
+	# Progress is published with `frappe.publish_progress`, the summary with the `bulk_rate_shopping` event.
+	shipments = frappe.parse_json(shipments)
+	check_shipment_permission(shipments, 'write', _('Not permitted to update Shipments'))
+
+	frappe.enqueue('erpnext_shipping.erpnext_shipping.rate_shopping.bulk_rate_shopping',
+		queue='long', timeout=3600, shipments=list(set(shipments)))
+	frappe.msgprint(_('Fetching rates for {0} Shipments in the background.').format(len(shipments)),
+		alert=True)
+
+def bulk_rate_shopping(shipments):
+	# Quote each distinct lane/parcel combination once and write the best quote to every Shipment sharing it
+	lanes, invalid = group_shipments_by_lane(shipments)
+	summary = frappe._dict(shipments=len(shipments), lanes=len(lanes), quoted=0, no_rates=0, failed=len(invalid))
+	if not lanes:
+		publish_summary(summary)
+		return summary
+
+	concurrency = cint(frappe.conf.get('shipping_bulk_rate_concurrency')) or DEFAULT_BULK_RATE_CONCURRENCY
+	lock = threading.Lock()
+	progress = frappe._dict(done=0)
+	lane_list = list(lanes.values())
+
+	def quote_lanes(lane_slice):
+		for lane in lane_slice:
+			status = quote_lane(lane)
+			with lock:
+				summary[status] += len(lane)
+				progress.done += 1
+				frappe.publish_progress(progress.done * 100 / len(lane_list), title=_('Fetching Shipping Rates'),
+					description=_('{0} of {1} lanes quoted').format(progress.done, len(lane_list)))
+
+	outcome = run_in_slices(quote_lanes, lane_list, concurrency)
+	for error in outcome.errors.values():
+		frappe.log_error(title=_('Error during bulk rate shopping'), message=repr(error))
+
+	publish_summary(summary)
+	return summary
+
+def group_shipments_by_lane(shipments):
+	# Return {rate signature: [shipment, ...]} and the Shipments that cannot be quoted.
+	# Addresses are resolved once per address.
+	shipment_docs = frappe.get_all('Shipment', filters={'name': ['in', shipments]}, fields=SHIPMENT_RATE_FIELDS)
+	shipment_docs += get_dunzo_fields(shipments)
+	parcels = get_shipment_parcels(shipments)
+
+	addresses, lanes, invalid = {}, {}, []
+	for shipment in merge_shipment_rows(shipment_docs):
+		try:
+			for address_name in (shipment.pickup_address_name, shipment.delivery_address_name):
+				if address_name not in addresses:
+					addresses[address_name] = get_address(address_name)
+		except Exception:
+			frappe.clear_messages()
+			frappe.log_error(title=_('Error while fetching rates for Shipment {0}').format(shipment.name))
+			invalid.append(shipment.name)
+			continue
+
+		shipment.shipment_parcel = json.dumps(parcels.get(shipment.name, []))
+		signature = get_rate_signature(
+			addresses[shipment.pickup_address_name],
+			addresses[shipment.delivery_address_name],
+			shipment.shipment_parcel,
+			shipment.pickup_date,
+			pickup_from_type=shipment.pickup_from_type,
+			delivery_to_type=shipment.delivery_to_type,
+			value_of_goods=shipment.value_of_goods,
+			pickup_address_gps=shipment.pickup_address_gps,
+			delivery_address_gps=shipment.delivery_address_gps,
+			collection_amount=shipment.collection_amount
+		)
+		lanes.setdefault(signature, []).append(shipment)
+	return lanes, invalid
+
+def get_dunzo_fields(shipments):
+	# Dunzo's custom fields only exist once Dunzo has been enabled
+	if not frappe.get_meta('Shipment').has_field('pickup_address_gps'):
+		return []
+	return frappe.get_all('Shipment', filters={'name': ['in', shipments]},
+		fields=['name', 'pickup_address_gps', 'delivery_address_gps', 'collection_amount'])
+
+def merge_shipment_rows(rows):
+	shipments = {}
+	for row in rows:
+		shipments.setdefault(row.name, frappe._dict()).update(row)
+	return list(shipments.values())
+
+def quote_lane(lane):
+	# Quote the first Shipment of the lane and write the cheapest rate to all of them
+	shipment = lane[0]
+	try:
+		jobs, signatures = get_rate_jobs(
+			shipment_doc=shipment.name,
+			pickup_from_type=shipment.pickup_from_type,
+			delivery_to_type=shipment.delivery_to_type,
+			pickup_address_name=shipment.pickup_address_name,
+			delivery_address_name=shipment.delivery_address_name,
+			shipment_parcel=shipment.shipment_parcel,
+			description_of_content=shipment.description_of_content,
+			pickup_date=shipment.pickup_date,
+			value_of_goods=shipment.value_of_goods,
+			pickup_contact_name=shipment.pickup_contact_person if shipment.pickup_from_type == 'Company' else shipment.pickup_contact_name,
+			delivery_contact_name=shipment.delivery_contact_name
+		)
+		rates = get_rate_quotes(jobs, signatures).rates
+		if not rates:
+			return 'no_rates'
+
+		set_quoted_rate([s.name for s in lane], rates[0])
+		frappe.db.commit()
+		return 'quoted'
+	except Exception:
+		frappe.db.rollback()
+		frappe.log_error(title=_('Error while fetching rates for Shipment {0}').format(shipment.name))
+		return 'failed'
+
+def set_quoted_rate(shipments, service_data):
+	frappe.db.set_value('Shipment', {'name': ['in', shipments]}, {
+		'quoted_service_provider': service_data.get('service_provider'),
+		'quoted_carrier': service_data.get('carrier'),
+		'quoted_carrier_service': service_data.get('service_name'),
+		'quoted_amount': service_data.get('total_price'),
+		'quoted_at': now_datetime(),
+		'quoted_service_data': json.dumps(service_data, default=str)
+	}, update_modified=False)
+
+def publish_summary(summary):
+	frappe.publish_realtime('bulk_rate_shopping', summary, user=frappe.session.user)
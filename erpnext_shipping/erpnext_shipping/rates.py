@@ -0,0 +1,229 @@
+# Copyright (c) 2023, Frappe and contributors
+# For license information, please see license.txt
+
+import frappe
+import json
+from frappe import _
+from frappe.utils import flt
+from erpnext.stock.doctype.shipment.shipment import get_company_contact
+from erpnext_shipping.erpnext_shipping.rate_cards import estimate_rates
+from erpnext_shipping.erpnext_shipping.rate_cache import get_cached_rates, get_rate_signature, set_cached_rates
+from erpnext_shipping.erpnext_shipping.utils import get_address, get_contact, match_parcel_service_type_carrier, run_concurrently
+from erpnext_shipping.erpnext_shipping.providers import get_provider, is_enabled
+from erpnext_shipping.erpnext_shipping.doctype.letmeship.letmeship import LETMESHIP_PROVIDER
+from erpnext_shipping.erpnext_shipping.doctype.packlink.packlink import PACKLINK_PROVIDER
+from erpnext_shipping.erpnext_shipping.doctype.sendcloud.sendcloud import SENDCLOUD_PROVIDER
+from erpnext_shipping.erpnext_shipping.doctype.shiprocket.shiprocket import SHIPROCKET_PROVIDER, get_shipment_weight
+from erpnext_shipping.erpnext_shipping.doctype.dunzo.dunzo import DUNZO_PROVIDER
+
+# Seconds to wait for a provider's quote, override with `shipping_rate_deadline`
+# or per provider with `shipping_rate_deadlines` in site_config.json
+DEFAULT_RATE_DEADLINE = 8
+
+def get_rate_deadline(service_provider):
+	deadlines = frappe.conf.get('shipping_rate_deadlines') or {}
+	return flt(deadlines.get(service_provider) or frappe.conf.get('shipping_rate_deadline') or DEFAULT_RATE_DEADLINE)
+
+def get_rate_jobs(shipment_doc, pickup_from_type, delivery_to_type, pickup_address_name, delivery_address_name,
+	shipment_parcel, description_of_content, pickup_date, value_of_goods,
+	pickup_contact_name=None, delivery_contact_name=None, cod=False):
+	# Return {service_provider: job} for every enabled provider and the cache signature of each quote.
+	# Addresses, contacts and clients are resolved here, so a job only waits on its carrier.
+	jobs, signatures = {}, {}
+	pickup_address = get_address(pickup_address_name)
+	delivery_address = get_address(delivery_address_name)
+	signature = get_rate_signature(pickup_address, delivery_address, shipment_parcel, pickup_date, cod)
+
+	if is_enabled(LETMESHIP_PROVIDER):
+		if pickup_from_type != 'Company':
+			pickup_contact = get_contact(pickup_contact_name)
+		else:
+			pickup_contact = get_company_contact(user=pickup_contact_name)
+
+		if delivery_to_type != 'Company':
+			delivery_contact = get_contact(delivery_contact_name)
+		else:
+			delivery_contact = get_company_contact(user=pickup_contact_name)
+
+		letmeship = get_provider(LETMESHIP_PROVIDER)
+		# LetMeShip trims the address titles in place, give it its own copies
+		letmeship_kwargs = dict(
+			delivery_to_type=delivery_to_type,
+			pickup_address=frappe._dict(pickup_address),
+			delivery_address=frappe._dict(delivery_address),
+			shipment_parcel=shipment_parcel,
+			description_of_content=description_of_content,
+			pickup_date=pickup_date,
+			value_of_goods=value_of_goods,
+			pickup_contact=pickup_contact,
+			delivery_contact=delivery_contact,
+		)
+
+		def get_letmeship_prices():
+			prices = letmeship.get_available_services(**letmeship_kwargs) or []
+			return match_parcel_service_type_carrier(prices, ['carrier', 'carrier_name'])
+
+		jobs[LETMESHIP_PROVIDER] = get_letmeship_prices
+		signatures[LETMESHIP_PROVIDER] = get_rate_signature(pickup_address, delivery_address, shipment_parcel,
+			pickup_date, cod, value_of_goods=value_of_goods, delivery_to_type=delivery_to_type)
+
+	if is_enabled(PACKLINK_PROVIDER):
+		packlink = get_provider(PACKLINK_PROVIDER)
+
+		def get_packlink_prices():
+			prices = packlink.get_available_services(
+				pickup_address=pickup_address,
+				delivery_address=delivery_address,
+				shipment_parcel=shipment_parcel,
+				pickup_date=pickup_date
+			) or []
+			return match_parcel_service_type_carrier(prices, ['carrier_name', 'carrier'])
+
+		jobs[PACKLINK_PROVIDER] = get_packlink_prices
+		signatures[PACKLINK_PROVIDER] = signature
+
+	if is_enabled(SENDCLOUD_PROVIDER) and pickup_from_type == 'Company':
+		sendcloud = get_provider(SENDCLOUD_PROVIDER)
+
+		def get_sendcloud_prices():
+			prices = sendcloud.get_available_services(
+				delivery_address=delivery_address,
+				shipment_parcel=shipment_parcel
+			) or []
+			return prices[:4] # remove after fixing scroll issue
+
+		jobs[SENDCLOUD_PROVIDER] = get_sendcloud_prices
+		signatures[SENDCLOUD_PROVIDER] = signature
+
+	if is_enabled(SHIPROCKET_PROVIDER):
+		weight = get_shipment_weight(json.loads(shipment_parcel))
+		shiprocket = get_provider(SHIPROCKET_PROVIDER)
+
+		def get_shiprocket_prices():
+			return shiprocket.get_available_services(
+				pickup_pincode=pickup_address.pincode,
+				delivery_pincode=delivery_address.pincode,
+				weight=weight,
+				cod=cod
+			)
+
+		jobs[SHIPROCKET_PROVIDER] = get_shiprocket_prices
+		signatures[SHIPROCKET_PROVIDER] = signature
+
+	if is_enabled(DUNZO_PROVIDER):
+		shipment = frappe.get_doc('Shipment', shipment_doc)
+		dunzo = get_provider(DUNZO_PROVIDER)
+
+		def get_dunzo_prices():
+			return dunzo.get_available_services(
+				pickup_address_gps=shipment.pickup_address_gps,
+				delivery_address_gps=shipment.delivery_address_gps,
+				cod=cod,
+				collection_amount=shipment.collection_amount
+			)
+
+		jobs[DUNZO_PROVIDER] = get_dunzo_prices
+		signatures[DUNZO_PROVIDER] = get_rate_signature(pickup_address, delivery_address, shipment_parcel,
+			pickup_date, cod, pickup_address_gps=shipment.pickup_address_gps,
+			delivery_address_gps=shipment.delivery_address_gps, collection_amount=shipment.collection_amount)
+
+	return jobs, signatures
+
+def get_rate_quotes(jobs, signatures=None, on_rates=None):
+	"""Query all providers at once, each bounded by its own deadline.
+	Providers with a cached quote for the same signature are not queried.
+	`on_rates(service_provider, rates)` is called as soon as a provider's rates are known.
+
+	Returns the merged `rates` sorted by total price, and the providers that
+	`timed_out` or `failed`."""
+	signatures = signatures or {}
+	rates, pending = [], {}
+	for provider, job in jobs.items():
+		cached_rates = get_cached_rates(provider, signatures.get(provider))
+		if cached_rates is None:
+			pending[provider] = job
+		else:
+			rates += cached_rates
+			if on_rates:
+				on_rates(provider, cached_rates)
+
+	def collect_rates(provider, provider_rates):
+		provider_rates = provider_rates or []
+		set_cached_rates(provider, signatures.get(provider), provider_rates)
+		rates.extend(provider_rates)
+		if on_rates:
+			on_rates(provider, provider_rates)
+
+	outcome = run_concurrently(pending, timeout={provider: get_rate_deadline(provider) for provider in pending},
+		on_result=collect_rates)
+
+	for provider, error in outcome.errors.items():
+		frappe.log_error(title=_('Error while fetching {0} prices').format(provider), message=repr(error))
+
+	return frappe._dict(
+		rates=sorted(rates, key=lambda k: k['total_price']),
+		timed_out=outcome.timed_out,
+		failed=list(outcome.errors)
+	)
+
+def get_estimated_rates(rate_args, service_providers=None):
+	# Rates from the Shipping Rate Cards for the same request, no carrier is called
+	return estimate_rates(
+		get_address(rate_args['pickup_address_name']),
+		get_address(rate_args['delivery_address_name']),
+		rate_args['shipment_parcel'],
+		cod=rate_args.get('cod'),
+		value_of_goods=rate_args.get('value_of_goods'),
+		service_providers=service_providers
+	)
+
+def add_estimated_rates(quotes, rate_args):
+	# Fill in estimates for the providers that timed out or failed, live quotes are never replaced
+	missing = quotes.timed_out + quotes.failed
+	quotes.estimated = []
+	if missing:
+		estimates = get_estimated_rates(rate_args, missing)
+		quotes.estimated = list({rate.service_provider for rate in estimates})
+		quotes.rates = sorted(quotes.rates + estimates, key=lambda k: k['total_price'])
+	return quotes
+
+def show_missing_providers_alert(quotes):
+	# Let the user know the list is partial
+	if quotes.timed_out:
+		frappe.msgprint(_('{0} did not respond in time, showing rates from the other providers.')
+			.format(', '.join(quotes.timed_out)), indicator='orange', alert=True)
+	if quotes.get('estimated'):
+		frappe.msgprint(_('Rates of {0} are estimated from Shipping Rate Cards.').format(', '.join(quotes.estimated)),
+			indicator='blue', alert=True)
+	if quotes.failed:
+		frappe.msgprint(_('Could not fetch rates from {0}.').format(', '.join(quotes.failed)),
+			indicator='orange', alert=True)
+
+def stream_shipping_rates(request_id, rate_args):
+	# Background job: publish each provider's rates with the `shipping_rates` realtime
+	# event as soon as they arrive, then a final event once every provider is done.
+	user = frappe.session.user
+
+	def publish(message):
+		message['request_id'] = request_id
+		frappe.publish_realtime('shipping_rates', message, user=user)
+
+	try:
+		jobs, signatures = get_rate_jobs(**rate_args)
+		quotes = get_rate_quotes(jobs, signatures,
+			on_rates=lambda provider, rates: publish({'service_provider': provider, 'rates': rates}))
+		for provider in quotes.timed_out + quotes.failed:
+			estimates = get_estimated_rates(rate_args, [provider])
+			if estimates:
+				publish({'service_provider': provider, 'rates': estimates, 'is_estimate': 1})
+	except Exception:
+		frappe.log_error(title=_('Error while fetching shipping rates'))
+		publish({'done': True, 'error': _('An Error occurred while fetching shipping rates.')})
+		return
+
+	publish({
+		'done': True,
+		'providers': list(jobs),
+		'timed_out': quotes.timed_out,
+		'failed': quotes.failed
+	})
@@ -3,103 +3,66 @@
 # For license information, please see license.txt
 from __future__ import unicode_literals
 import frappe
+import hashlib
 import json
 from six import string_types
 from frappe import _
-from frappe.utils import flt
+from datetime import datetime
+from frappe.utils import cint, cstr, flt
 from erpnext.stock.doctype.shipment.shipment import get_company_contact
-from erpnext_shipping.erpnext_shipping.utils import get_address, get_contact, match_parcel_service_type_carrier
-from erpnext_shipping.erpnext_shipping.doctype.letmeship.letmeship import LETMESHIP_PROVIDER, LetMeShipUtils
-from erpnext_shipping.erpnext_shipping.doctype.packlink.packlink import PACKLINK_PROVIDER, PackLinkUtils
-from erpnext_shipping.erpnext_shipping.doctype.sendcloud.sendcloud import SENDCLOUD_PROVIDER, SendCloudUtils
-from erpnext_shipping.erpnext_shipping.doctype.shiprocket.shiprocket import SHIPROCKET_PROVIDER, ShiprocketUtils
-from erpnext_shipping.erpnext_shipping.doctype.dunzo.dunzo import DUNZO_PROVIDER, DunzoUtils
+from erpnext_shipping.erpnext_shipping.utils import get_address, get_contact
+from erpnext_shipping.erpnext_shipping.rates import (add_estimated_rates, get_estimated_rates, get_rate_jobs,
+	get_rate_quotes, show_missing_providers_alert)
+from erpnext_shipping.erpnext_shipping import labels, providers
+
+SHIPMENT_BOOKING_FIELDS = ['service_provider', 'carrier', 'carrier_service', 'shipment_id', 'shipment_amount', 'awb_number']
+SHIPMENT_TRACKING_FIELDS = ['awb_number', 'tracking_status', 'tracking_status_info', 'tracking_url', 'delivered_at']
 
 @frappe.whitelist()
 def fetch_shipping_rates(shipment_doc, pickup_from_type, delivery_to_type, pickup_address_name, delivery_address_name,
 	shipment_parcel, description_of_content, pickup_date, value_of_goods,
-	pickup_contact_name=None, delivery_contact_name=None, cod=False):
-	# Return Shipping Rates for the various Shipping Providers
-	shipment_prices = []
-	letmeship_enabled = frappe.db.get_single_value('LetMeShip','enabled')
-	packlink_enabled = frappe.db.get_single_value('Packlink','enabled')
-	sendcloud_enabled = frappe.db.get_single_value('SendCloud','enabled')
-	shiprocket_enabled = frappe.db.get_single_value('Shiprocket','enabled')
-	dunzo_enabled = frappe.db.get_single_value('Dunzo','enabled')
-	pickup_address = get_address(pickup_address_name)
-	delivery_address = get_address(delivery_address_name)
-
-	if letmeship_enabled:
-		pickup_contact = None
-		delivery_contact = None
-		if pickup_from_type != 'Company':
-			pickup_contact = get_contact(pickup_contact_name)
-		else:
-			pickup_contact = get_company_contact(user=pickup_contact_name)
-
-		if delivery_to_type != 'Company':
-			delivery_contact = get_contact(delivery_contact_name)
-		else:
-			delivery_contact = get_company_contact(user=pickup_contact_name)
+	pickup_contact_name=None, delivery_contact_name=None, cod=False, estimate=False):
+	# Return Shipping Rates for the various Shipping Providers, queried concurrently or from the rate cache.
+	# Providers that time out or fail are estimated from the Shipping Rate Cards. With `estimate`,
+	# only the Shipping Rate Cards are used and no provider is queried.
+	rate_args = dict(pickup_address_name=pickup_address_name, delivery_address_name=delivery_address_name,
+		shipment_parcel=shipment_parcel, cod=cod, value_of_goods=value_of_goods)
+	if cint(estimate):
+		return get_estimated_rates(rate_args)
+
+	jobs, signatures = get_rate_jobs(shipment_doc, pickup_from_type, delivery_to_type, pickup_address_name,
+		delivery_address_name, shipment_parcel, description_of_content, pickup_date, value_of_goods,
+		pickup_contact_name=pickup_contact_name, delivery_contact_name=delivery_contact_name, cod=cod)
+	quotes = add_estimated_rates(get_rate_quotes(jobs, signatures), rate_args)
+	show_missing_providers_alert(quotes)
+	return quotes.rates
 
-		letmeship = LetMeShipUtils()
-		letmeship_prices = letmeship.get_available_services(
+@frappe.whitelist()
+def fetch_shipping_rates_async(shipment_doc, pickup_from_type, delivery_to_type, pickup_address_name, delivery_address_name,
+	shipment_parcel, description_of_content, pickup_date, value_of_goods,
+	pickup_contact_name=None, delivery_contact_name=None, cod=False, request_id=None):
+	# Enqueue fetching of Shipping Rates and return the request id.
+	# Rates are pushed to the user with the `shipping_rates` realtime event, one provider at a time.
+	request_id = request_id or frappe.generate_hash(length=10)
+	frappe.enqueue('erpnext_shipping.erpnext_shipping.rates.stream_shipping_rates',
+		queue='short',
+		request_id=request_id,
+		rate_args=dict(
+			shipment_doc=shipment_doc,
+			pickup_from_type=pickup_from_type,
 			delivery_to_type=delivery_to_type,
-			pickup_address=pickup_address,
-			delivery_address=delivery_address,
+			pickup_address_name=pickup_address_name,
+			delivery_address_name=delivery_address_name,
 			shipment_parcel=shipment_parcel,
 			description_of_content=description_of_content,
 			pickup_date=pickup_date,
 			value_of_goods=value_of_goods,
-			pickup_contact=pickup_contact,
-			delivery_contact=delivery_contact,
-		) or []
-		letmeship_prices = match_parcel_service_type_carrier(letmeship_prices, ['carrier', 'carrier_name'])
-		shipment_prices = shipment_prices + letmeship_prices
-
-	if packlink_enabled:
-		packlink = PackLinkUtils()
-		packlink_prices = packlink.get_available_services(
-			pickup_address=pickup_address,
-			delivery_address=delivery_address,
-			shipment_parcel=shipment_parcel,
-			pickup_date=pickup_date
-		) or []
-		packlink_prices = match_parcel_service_type_carrier(packlink_prices, ['carrier_name', 'carrier'])
-		shipment_prices = shipment_prices + packlink_prices
-
-	if sendcloud_enabled and pickup_from_type == 'Company':
-		sendcloud = SendCloudUtils()
-		sendcloud_prices = sendcloud.get_available_services(
-			delivery_address=delivery_address,
-			shipment_parcel=shipment_parcel
-		) or []
-		shipment_prices = shipment_prices + sendcloud_prices[:4] # remove after fixing scroll issue
-	if shiprocket_enabled:
-		shipment_parcel = json.loads(shipment_parcel)
-		weight = 0
-		for parcel in shipment_parcel:
-			weight += parcel.get('weight')
-		shiprocket = ShiprocketUtils()
-		shiprocket_prices = shiprocket.get_available_services(
-			pickup_pincode=pickup_address.pincode,
-			delivery_pincode=delivery_address.pincode,
-			weight = weight,
+			pickup_contact_name=pickup_contact_name,
+			delivery_contact_name=delivery_contact_name,
 			cod=cod
 		)
-		shipment_prices = shipment_prices + shiprocket_prices
-	if dunzo_enabled:
-		shipment = frappe.get_doc("Shipment", shipment_doc)
-		dunzo = DunzoUtils()
-		dunzo_prices = dunzo.get_available_services(
-			pickup_address_gps=shipment.pickup_address_gps,
-			delivery_address_gps=shipment.delivery_address_gps,
-			cod=cod,
-			collection_amount=shipment.collection_amount
-		)
-		shipment_prices = shipment_prices + dunzo_prices
-	shipment_prices = sorted(shipment_prices, key=lambda k:k['total_price'])
-	return shipment_prices
+	)
+	return request_id
 
 @frappe.whitelist()
 def create_shipment(shipment, pickup_from_type, delivery_to_type, pickup_address_name,
@@ -108,6 +71,12 @@ def create_shipment(shipment, pickup_from_type, delivery_to_type, pickup_address
 		pickup_contact_name=None, delivery_contact_name=None, delivery_notes=[]):
 	# Create Shipment for the selected provider
 	service_info = json.loads(service_data)
+	if service_info.get('is_estimate'):
+		frappe.throw(_('{0} rates estimated from a Shipping Rate Card cannot be booked, please fetch live rates.')
+			.format(service_info.get('service_provider')), title=_('Estimated Rate'))
+	# Lock the Shipment until the booking is committed, so it can't be booked twice at the same time
+	if frappe.db.get_value('Shipment', shipment, 'shipment_id', for_update=True):
+		frappe.throw(_('Shipment {0} is already booked').format(shipment), title=_('Already Booked'))
 	shipment_info, pickup_contact,  delivery_contact = None, None, None
 	pickup_address = get_address(pickup_address_name)
 	delivery_address = get_address(delivery_address_name)
@@ -122,150 +91,98 @@ def create_shipment(shipment, pickup_from_type, delivery_to_type, pickup_address
 	else:
 		delivery_contact = get_company_contact(user=pickup_contact_name)
 
-	if service_info['service_provider'] == LETMESHIP_PROVIDER:
-		letmeship = LetMeShipUtils()
-		shipment_info = letmeship.create_shipment(
-			pickup_address=pickup_address,
-			delivery_address=delivery_address,
-			shipment_parcel=shipment_parcel,
-			description_of_content=description_of_content,
-			pickup_date=pickup_date,
-			value_of_goods=value_of_goods,
-			pickup_contact=pickup_contact,
-			delivery_contact=delivery_contact,
-			service_info=service_info
-		)
-
-	if service_info['service_provider'] == PACKLINK_PROVIDER:
-		packlink = PackLinkUtils()
-		shipment_info = packlink.create_shipment(
-			pickup_address=pickup_address,
-			delivery_address=delivery_address,
-			shipment_parcel=shipment_parcel,
-			description_of_content=description_of_content,
-			pickup_date=pickup_date,
-			value_of_goods=value_of_goods,
-			pickup_contact=pickup_contact,
-			delivery_contact=delivery_contact,
-			service_info=service_info,
-		)
-
-	if service_info['service_provider'] == SENDCLOUD_PROVIDER:
-		sendcloud = SendCloudUtils()
-		shipment_info = sendcloud.create_shipment(
-			shipment=shipment,
-			delivery_address=delivery_address,
-			shipment_parcel=shipment_parcel,
-			description_of_content=description_of_content,
-			value_of_goods=value_of_goods,
-			delivery_contact=delivery_contact,
-			service_info=service_info,
-		)
-	
-	if service_info['service_provider'] == SHIPROCKET_PROVIDER:
-		shiprocket = ShiprocketUtils()
-		shipment_info = shiprocket.create_shipment(
-			shipment=shipment,
-			pickup_address=pickup_address,
-			delivery_address=delivery_address,
-			shipment_parcel=shipment_parcel,
-			service_info=service_info,
-			delivery_notes=delivery_notes,
-			delivery_contact=delivery_contact	
-		)
-	
-	if service_info['service_provider'] == DUNZO_PROVIDER:
-		dunzo = DunzoUtils()
-		shipment_info = dunzo.create_shipment(
-			shipment=shipment,
-			pickup_address=pickup_address,
-			delivery_address=delivery_address,
-			delivery_contact=delivery_contact,
-			pickup_contact=pickup_contact	
-		)
+	shipment_info = providers.create_shipment(
+		service_info['service_provider'],
+		shipment=shipment,
+		pickup_address=pickup_address,
+		delivery_address=delivery_address,
+		shipment_parcel=shipment_parcel,
+		description_of_content=description_of_content,
+		pickup_date=pickup_date,
+		value_of_goods=value_of_goods,
+		pickup_contact=pickup_contact,
+		delivery_contact=delivery_contact,
+		service_info=service_info,
+		delivery_notes=delivery_notes
+	)
 
 	if shipment_info:
-		fields = ['service_provider', 'carrier', 'carrier_service', 'shipment_id', 'shipment_amount', 'awb_number']
-		for field in fields:
-			frappe.db.set_value('Shipment', shipment, field, shipment_info.get(field))
-		frappe.db.set_value('Shipment', shipment, 'status', 'Booked')
+		values = {field: shipment_info.get(field) for field in SHIPMENT_BOOKING_FIELDS}
+		values['status'] = 'Booked'
+		frappe.db.set_value('Shipment', shipment, values)
 
 		if delivery_notes:
 			update_delivery_note(delivery_notes=delivery_notes, shipment_info=shipment_info)
 
+		labels.enqueue_label_prefetch(shipment, service_info['service_provider'])
+
 	return shipment_info
 
 @frappe.whitelist()
 def print_shipping_label(service_provider, shipment_id):
-	shipping_label = None
-	if service_provider == LETMESHIP_PROVIDER:
-		letmeship = LetMeShipUtils()
-		shipping_label = letmeship.get_label(shipment_id)
-	elif service_provider == PACKLINK_PROVIDER:
-		packlink = PackLinkUtils()
-		shipping_label = packlink.get_label(shipment_id)
-	elif service_provider == SENDCLOUD_PROVIDER:
-		sendcloud = SendCloudUtils()
-		shipping_label = sendcloud.get_label(shipment_id)
-	elif service_provider == SHIPROCKET_PROVIDER:
-		shiprocket = ShiprocketUtils()
-		shipping_label = shiprocket.get_label(shipment_id)
-	return shipping_label
+	# Serve the label stored after booking, the carrier is only asked if there is none yet
+	return labels.get_stored_label(service_provider, shipment_id) or \
+		providers.call_provider(service_provider, 'get_label', shipment_id)
 
 @frappe.whitelist()
 def update_tracking(shipment, service_provider, shipment_id, delivery_notes=[]):
 	# Update Tracking info in Shipment
-	tracking_data = None
-	if service_provider == LETMESHIP_PROVIDER:
-		letmeship = LetMeShipUtils()
-		tracking_data = letmeship.get_tracking_data(shipment_id)
-	elif service_provider == PACKLINK_PROVIDER:
-		packlink = PackLinkUtils()
-		tracking_data = packlink.get_tracking_data(shipment_id)
-	elif service_provider == SENDCLOUD_PROVIDER:
-		sendcloud = SendCloudUtils()
-		tracking_data = sendcloud.get_tracking_data(shipment_id)
-	elif service_provider == SHIPROCKET_PROVIDER:
-		shiprocket = ShiprocketUtils()
-		tracking_data = shiprocket.get_tracking_data(shipment_id)
-	elif service_provider == DUNZO_PROVIDER:
-		dunzo = DunzoUtils()
-		tracking_data = dunzo.get_tracking_data(shipment_id)
+	tracking_data = providers.call_provider(service_provider, 'get_tracking_data', shipment_id)
 
 	if tracking_data:
-		fields = ['awb_number', 'tracking_status', 'tracking_status_info', 'tracking_url', 'delivered_at']
-		for field in fields:
-			frappe.db.set_value('Shipment', shipment, field, tracking_data.get(field))
-
-		if delivery_notes:
-			update_delivery_note(delivery_notes=delivery_notes, tracking_info=tracking_data)
+		current = frappe.db.get_value('Shipment', shipment, SHIPMENT_TRACKING_FIELDS + ['tracking_fingerprint'], as_dict=True)
+		set_tracking_data(shipment, tracking_data, delivery_notes, current=current)
 	
 	return tracking_data
 
+def set_tracking_data(shipment, tracking_data, delivery_notes=None, current=None):
+	# Write tracking data, as returned by a provider's get_tracking_data, to the Shipment and its Delivery Notes.
+	# Nothing is written if it matches `current`, the Shipment's stored tracking fields. Returns whether it wrote.
+	values = {field: tracking_data.get(field) for field in SHIPMENT_TRACKING_FIELDS}
+	values['tracking_fingerprint'] = get_tracking_fingerprint(values)
+	if current and values['tracking_fingerprint'] == (current.get('tracking_fingerprint') or get_tracking_fingerprint(current)):
+		return False
+
+	frappe.db.set_value('Shipment', shipment, values)
+	if delivery_notes:
+		update_delivery_note(delivery_notes=delivery_notes, tracking_info=tracking_data)
+	return True
+
+def get_tracking_fingerprint(tracking_data):
+	# Short hash of the tracking fields, equal for payloads that would write the same values
+	def comparable(value):
+		# Carriers may return timezone aware datetimes, the database stores naive ones
+		if isinstance(value, datetime):
+			return str(value.replace(tzinfo=None, microsecond=0))
+		return cstr(value)
+
+	values = [comparable(tracking_data.get(field)) for field in SHIPMENT_TRACKING_FIELDS]
+	return hashlib.sha1(json.dumps(values).encode()).hexdigest()[:16]
+
 @frappe.whitelist()
 def get_shipment_details(service_provider, shipment_id):
-	if service_provider == SHIPROCKET_PROVIDER:
-		shiprocket = ShiprocketUtils()
-		shipment_details = shiprocket.get_shipment_details(shipment_id)
-
-	return shipment_details
+	return providers.call_provider(service_provider, 'get_shipment_details', shipment_id)
 
 def update_delivery_note(delivery_notes, shipment_info=None, tracking_info=None):
 	# Update Shipment Info in Delivery Note
-	# Using db_set since some services might not exist
+	# All Delivery Notes are updated in one statement, without loading them
 	if isinstance(delivery_notes, string_types):
 		delivery_notes = json.loads(delivery_notes)
 
-	delivery_notes = list(set(delivery_notes))
-
-	for delivery_note in delivery_notes:
-		dl_doc = frappe.get_doc('Delivery Note', delivery_note)
-		if shipment_info:
-			dl_doc.db_set('delivery_type', 'Parcel Service')
-			dl_doc.db_set('parcel_service', shipment_info.get('carrier'))
-			dl_doc.db_set('parcel_service_type', shipment_info.get('carrier_service'))
-		if tracking_info:
-			dl_doc.db_set('tracking_number', tracking_info.get('awb_number'))
-			dl_doc.db_set('tracking_url', tracking_info.get('tracking_url'))
-			dl_doc.db_set('tracking_status', tracking_info.get('tracking_status'))
-			dl_doc.db_set('tracking_status_info', tracking_info.get('tracking_status_info'))
\ No newline at end of file
+	values = {}
+	if shipment_info:
+		values.update({
+			'delivery_type': 'Parcel Service',
+			'parcel_service': shipment_info.get('carrier'),
+			'parcel_service_type': shipment_info.get('carrier_service')
+		})
+	if tracking_info:
+		values.update({
+			'tracking_number': tracking_info.get('awb_number'),
+			'tracking_url': tracking_info.get('tracking_url'),
+			'tracking_status': tracking_info.get('tracking_status'),
+			'tracking_status_info': tracking_info.get('tracking_status_info')
+		})
+
+	if delivery_notes and values:
+		frappe.db.set_value('Delivery Note', {'name': ['in', list(set(delivery_notes))]}, values)
@@ -0,0 +1,87 @@
+# Copyright (c) 2023, Frappe and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.utils import cint
+from erpnext_shipping.erpnext_shipping.doctype.shiprocket.shiprocket import SHIPROCKET_PROVIDER
+
+# Held while the pickups of one location and day are requested, so they are requested once
+PICKUP_BATCH_LOCK = 'erpnext_shipping:shiprocket_pickups:{0}:{1}'
+DEFAULT_PICKUP_BATCH_SIZE = 20
+
+def queue_pickup(shipment, pickup_location, pickup_date, batch_size=None):
+	# Mark a booked Shipment as waiting for a pickup, a full batch is sent right away.
+	# The mark is written with the booking, so a waiting pickup is never lost.
+	frappe.db.set_value('Shipment', shipment, {'pickup_status': 'Pending', 'pickup_location': pickup_location},
+		update_modified=False)
+	# The Shipment itself isn't counted, its booking is written after this
+	pending = frappe.db.count('Shipment', get_pending_filters(pickup_location, pickup_date)) + 1
+	if pending >= (cint(batch_size) or DEFAULT_PICKUP_BATCH_SIZE):
+		frappe.enqueue('erpnext_shipping.erpnext_shipping.shiprocket_pickups.flush_pickup_batch',
+			pickup_location=pickup_location, pickup_date=pickup_date, enqueue_after_commit=True)
+
+def get_pending_filters(pickup_location=None, pickup_date=None):
+	filters = {'service_provider': SHIPROCKET_PROVIDER, 'docstatus': 1, 'pickup_status': 'Pending',
+		'shipment_id': ['is', 'set']}
+	if pickup_location:
+		filters.update({'pickup_location': pickup_location, 'pickup_date': pickup_date})
+	return filters
+
+def flush_pickup_batches():
+	# Scheduled: send all waiting pickups, so small batches don't wait for their threshold
+	for batch in frappe.get_all('Shipment', filters=get_pending_filters(),
+		fields=['pickup_location', 'pickup_date'], distinct=True):
+		flush_pickup_batch(batch.pickup_location, batch.pickup_date)
+
+def flush_pickup_batch(pickup_location, pickup_date):
+	from erpnext_shipping.erpnext_shipping.providers import get_provider, is_enabled
+
+	if not is_enabled(SHIPROCKET_PROVIDER):
+		# Pickups keep waiting until Shiprocket is enabled again
+		return
+
+	cache = frappe.cache()
+	with cache.lock(cache.make_key(PICKUP_BATCH_LOCK.format(pickup_location, pickup_date)), timeout=300):
+		# Read inside the lock, pickups sent by a flush that held it are no longer pending
+		pickups = frappe.get_all('Shipment', filters=get_pending_filters(pickup_location, pickup_date),
+			fields=['name as shipment', 'shipment_id'], order_by='creation')
+		if pickups:
+			schedule_pickups(get_provider(SHIPROCKET_PROVIDER), pickups)
+			frappe.db.commit()
+
+def schedule_pickups(shiprocket, pickups):
+	# Request one pickup for all Shipments. If Shiprocket rejects it, the batch is split in halves
+	# until the Shipments it rejects are found, so they don't hold up the others.
+	# A Shipment stays pending until Shiprocket accepts or rejects its pickup.
+	try:
+		response = shiprocket.generate_pickup([p['shipment_id'] for p in pickups])
+	except Exception as e:
+		if len(pickups) > 1:
+			middle = len(pickups) // 2
+			schedule_pickups(shiprocket, pickups[:middle])
+			schedule_pickups(shiprocket, pickups[middle:])
+		else:
+			frappe.log_error(title=_('Error while generating pickup for Shipment {0}').format(pickups[0]['shipment']))
+			set_pickup_status(pickups, 'Failed')
+			add_pickup_comment(pickups[0]['shipment'], _('Shiprocket pickup could not be generated: {0}').format(e))
+		return
+
+	set_pickup_status(pickups, 'Scheduled')
+	details = response.get('response') or {}
+	for pickup in pickups:
+		add_pickup_comment(pickup['shipment'], _('Shiprocket pickup scheduled for {0}, token {1}').format(
+			details.get('pickup_scheduled_date'), details.get('pickup_token_number')))
+
+def set_pickup_status(pickups, status):
+	frappe.db.set_value('Shipment', {'name': ['in', [p['shipment'] for p in pickups]]}, 'pickup_status', status,
+		update_modified=False)
+
+def add_pickup_comment(shipment, comment):
+	frappe.get_doc({
+		'doctype': 'Comment',
+		'comment_type': 'Info',
+		'reference_doctype': 'Shipment',
+		'reference_name': shipment,
+		'content': comment
+	}).insert(ignore_permissions=True)
@@ -0,0 +1,135 @@
+# Copyright (c) 2023, Frappe and contributors
+# For license information, please see license.txt
+
+import frappe
+import json
+import time
+import numpy as np
+from bisect import bisect_left
+from frappe.utils import cint, flt
+
+# Serviceability of the lanes seen from one pickup pincode: the sorted lane keys (delivery pincode and
+# weight band), and per lane a bitset over the known couriers for each of "serves it" and "serves it with COD"
+SERVICEABILITY_KEY = 'erpnext_shipping:shiprocket_serviceability:{0}'
+# Courier lists returned by Shiprocket, waiting to be merged into the index of their pickup pincode
+OBSERVATIONS_KEY = 'erpnext_shipping:shiprocket_serviceability_observations:{0}'
+# Pickup pincodes that may have waiting observations
+PENDING_PICKUPS_KEY = 'erpnext_shipping:shiprocket_serviceability_pending'
+# Seconds a lane's couriers are trusted, after that the lane is unknown until it is quoted again
+SERVICEABILITY_TTL = 7 * 24 * 60 * 60
+# Upper bounds in kg of the weight bands, couriers offered by Shiprocket depend on the weight
+WEIGHT_BANDS = [0.5, 1, 2, 5, 10, 20, 50]
+
+def get_serviceable_couriers(pickup_pincode, delivery_pincode, weight, cod=False):
+	# Courier company ids Shiprocket offered on the lane for the weight band, with COD if asked.
+	# None if the lane is unknown. Only answers listing couriers are kept, so an empty answer is never trusted.
+	pickup, lane = get_pincode_number(pickup_pincode), get_lane_key(delivery_pincode, weight)
+	if pickup is None or lane is None:
+		return None
+	index = frappe.cache().get_value(SERVICEABILITY_KEY.format(pickup))
+	if not index:
+		return None
+
+	i = np.searchsorted(index['lanes'], lane)
+	if i >= len(index['lanes']) or index['lanes'][i] != lane:
+		return None
+	if index['observed_at'][i] < time.time() - SERVICEABILITY_TTL:
+		return None
+	if not cod and not index['complete'][i]:
+		# Only quoted with COD so far, couriers without COD are not known
+		return None
+	bits = np.unpackbits(index['cod' if cod else 'served'][i], count=len(index['couriers']))
+	return [courier for courier, bit in zip(index['couriers'], bits) if bit]
+
+def get_pincode_number(pincode):
+	pincode = str(pincode or '').replace(' ', '')
+	return int(pincode) if pincode.isdigit() else None
+
+def get_lane_key(delivery_pincode, weight):
+	# Delivery pincode followed by two digits for the weight band
+	delivery = get_pincode_number(delivery_pincode)
+	if delivery is None:
+		return None
+	return delivery * 100 + bisect_left(WEIGHT_BANDS, flt(weight))
+
+def record_serviceability(pickup_pincode, delivery_pincode, weight, courier_companies, cod=False):
+	# Queue the couriers Shiprocket returned for a lane, they are merged into the index in the background.
+	# Empty answers are not kept, Shiprocket also returns them on hiccups.
+	pickup, lane = get_pincode_number(pickup_pincode), get_lane_key(delivery_pincode, weight)
+	if pickup is None or lane is None or not courier_companies:
+		return
+	served = [cint(c.get('courier_company_id')) for c in courier_companies]
+	# With COD asked for, only couriers offering COD are returned
+	cod_served = served if cod else [cint(c.get('courier_company_id')) for c in courier_companies if cint(c.get('cod'))]
+
+	cache = frappe.cache()
+	# Marked pending after the push, so a build that unmarks the pickup either reads it or sees the mark
+	cache.rpush(OBSERVATIONS_KEY.format(pickup), json.dumps([lane, served, cod_served, bool(cod), int(time.time())]))
+	cache.sadd(PENDING_PICKUPS_KEY, pickup)
+
+def build_serviceability_indexes():
+	# Scheduled: merge the waiting observations of every pickup pincode
+	for pickup in frappe.cache().smembers(PENDING_PICKUPS_KEY):
+		build_serviceability_index(cint(frappe.safe_decode(pickup)))
+
+def build_serviceability_index(pickup):
+	cache = frappe.cache()
+	key = OBSERVATIONS_KEY.format(pickup)
+	with cache.lock(cache.make_key(SERVICEABILITY_KEY.format(pickup) + ':lock'), timeout=120):
+		# Unmarked before reading, observations recorded meanwhile mark the pickup again
+		cache.srem(PENDING_PICKUPS_KEY, pickup)
+		observations = [json.loads(frappe.safe_decode(o)) for o in cache.lrange(key, 0, -1)]
+		cache.ltrim(key, len(observations), -1)
+		if not observations:
+			return
+
+		lanes = get_lanes(cache.get_value(SERVICEABILITY_KEY.format(pickup)))
+		lanes = merge_observations(lanes, observations)
+		expired = time.time() - SERVICEABILITY_TTL
+		lanes = {key: lane for key, lane in lanes.items() if lane[2] >= expired}
+		cache.set_value(SERVICEABILITY_KEY.format(pickup), get_index(lanes))
+
+def merge_observations(lanes, observations):
+	for key, served, cod_served, cod, observed_at in observations:
+		complete = not cod
+		if cod and key in lanes:
+			# Couriers without COD were left out of the answer, keep what is known about them
+			served = set(served) | lanes[key][0]
+			complete = lanes[key][3]
+		lanes[key] = (set(served), set(cod_served), observed_at, complete)
+	return lanes
+
+def get_lanes(index):
+	# {lane key: (served courier ids, COD courier ids, observed at, served ids complete)} of an index
+	if not index:
+		return {}
+	count = len(index['couriers'])
+	lanes = {}
+	for i, key in enumerate(index['lanes'].tolist()):
+		served = np.unpackbits(index['served'][i], count=count)
+		cod = np.unpackbits(index['cod'][i], count=count)
+		lanes[key] = (
+			{c for c, bit in zip(index['couriers'], served) if bit},
+			{c for c, bit in zip(index['couriers'], cod) if bit},
+			int(index['observed_at'][i]),
+			bool(index['complete'][i])
+		)
+	return lanes
+
+def get_index(lanes):
+	couriers = sorted(set().union(*[lane[0] | lane[1] for lane in lanes.values()]))
+	position = {courier: i for i, courier in enumerate(couriers)}
+	keys = sorted(lanes)
+	served = np.zeros((len(keys), len(couriers)), dtype=np.uint8)
+	cod = np.zeros((len(keys), len(couriers)), dtype=np.uint8)
+	for row, key in enumerate(keys):
+		served[row, [position[c] for c in lanes[key][0]]] = 1
+		cod[row, [position[c] for c in lanes[key][1]]] = 1
+	return {
+		'couriers': couriers,
+		'lanes': np.array(keys, dtype=np.int64),
+		'observed_at': np.array([lanes[key][2] for key in keys], dtype=np.int64),
+		'complete': np.array([lanes[key][3] for key in keys], dtype=bool),
+		'served': np.packbits(served, axis=1),
+		'cod': np.packbits(cod, axis=1)
+	}
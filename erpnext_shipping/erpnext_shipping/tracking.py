@@ -0,0 +1,277 @@
+# Copyright (c) 2023, Frappe and contributors
+# For license information, please see license.txt
+
+import frappe
+import time
+from functools import partial
+from frappe import _
+from frappe.utils import add_to_date, cint, flt, get_datetime, now_datetime
+from erpnext_shipping.erpnext_shipping.doctype.dunzo.dunzo import DUNZO_PROVIDER
+from erpnext_shipping.erpnext_shipping.providers import PROVIDERS, call_provider
+from erpnext_shipping.erpnext_shipping.utils import check_shipment_permission, run_concurrently, run_in_slices
+
+# Shipments refreshed by one background job
+TRACKING_CHUNK_SIZE = 500
+# Tracking calls in flight per provider within a job, override with
+# `shipping_tracking_concurrency` in site_config.json, e.g. {"Shiprocket": 16}
+DEFAULT_TRACKING_CONCURRENCY = 4
+
+# Minutes until a Shipment is tracked again, by how active it is. Override with
+# `shipping_tracking_poll_intervals` in site_config.json, e.g. {"in_transit": 120}
+DEFAULT_TRACKING_POLL_INTERVALS = {
+	'hyperlocal': 5,
+	'out_for_delivery': 30,
+	'new': 60,
+	'in_transit': 240,
+	'stale': 720,
+	'stuck': 1440,
+	'abandoned': 4320,
+}
+# Providers delivering within hours, polled often on the day they are booked
+HYPERLOCAL_PROVIDERS = [DUNZO_PROVIDER]
+# Statuses that never change again
+FINAL_TRACKING_STATUSES = ['Delivered', 'Returned', 'Lost']
+# Carrier statuses of a parcel on its last mile
+OUT_FOR_DELIVERY_STATUSES = ['out for delivery', 'out_for_delivery', 'started_for_delivery', 'reached_for_delivery']
+# Seconds a refresh job may run
+TRACKING_JOB_TIMEOUT = 3600
+# Due Shipments picked up per scheduler tick, and the minutes they stay reserved for the job tracking them
+TRACKING_POLL_BATCH_SIZE = 5000
+TRACKING_POLL_LEASE = TRACKING_JOB_TIMEOUT // 60
+# Shipments written between commits
+TRACKING_COMMIT_BATCH_SIZE = 100
+TRACKING_SAVEPOINT = 'tracking_refresh'
+
+TRACKING_STATS_KEY = 'erpnext_shipping:tracking_stats:{0}:{1}'
+TRACKING_COUNTERS = ('shipments', 'updated', 'suppressed', 'no_data', 'failed')
+
+def get_open_shipments(filters=None, **kwargs):
+	# Booked Shipments that are not delivered yet, with the names of their Delivery Notes
+	shipments = frappe.get_all('Shipment', filters=dict({
+		'docstatus': 1,
+		'status': 'Booked',
+		'shipment_id': ['!=', ''],
+		'tracking_status': ['!=', 'Delivered'],
+	}, **(filters or {})), fields=['name', 'service_provider', 'shipment_id', 'creation',
+		'awb_number', 'tracking_status', 'tracking_status_info', 'tracking_url', 'delivered_at',
+		'tracking_fingerprint'], **kwargs)
+	return add_delivery_notes(shipments)
+
+def poll_due_shipments():
+	# Scheduled every few minutes: track the Shipments whose next poll is due
+	now = now_datetime()
+	shipments = get_open_shipments(
+		filters={'tracking_status': ['not in', FINAL_TRACKING_STATUSES]},
+		or_filters=[['next_tracking_poll', 'is', 'not set'], ['next_tracking_poll', '<=', now]],
+		order_by='next_tracking_poll asc',
+		limit=cint(frappe.conf.get('shipping_tracking_poll_batch_size')) or TRACKING_POLL_BATCH_SIZE
+	)
+	if not shipments:
+		return
+
+	# Reserve them, so the next ticks don't queue them again while the jobs are running
+	lease = add_to_date(now, minutes=TRACKING_POLL_LEASE)
+	frappe.db.set_value('Shipment', {'name': ['in', [s.name for s in shipments]]},
+		'next_tracking_poll', lease, update_modified=False)
+	frappe.db.commit()
+	enqueue_tracking_refresh(shipments, lease=lease)
+
+def get_next_tracking_poll(shipment, tracking_status=None, tracking_status_info=None):
+	# When to track the Shipment again, None once its status is final
+	if tracking_status in FINAL_TRACKING_STATUSES:
+		return None
+
+	intervals = dict(DEFAULT_TRACKING_POLL_INTERVALS)
+	intervals.update(frappe.conf.get('shipping_tracking_poll_intervals') or {})
+	now = now_datetime()
+	age_in_days = (now - get_datetime(shipment.creation)).total_seconds() / 86400
+	status_info = (tracking_status_info or '').lower()
+
+	if shipment.service_provider in HYPERLOCAL_PROVIDERS and age_in_days < 1:
+		interval = 'hyperlocal'
+	elif any(status in status_info for status in OUT_FOR_DELIVERY_STATUSES):
+		interval = 'out_for_delivery'
+	elif age_in_days > 30:
+		interval = 'abandoned'
+	elif age_in_days > 14:
+		interval = 'stuck'
+	elif age_in_days > 7:
+		interval = 'stale'
+	elif age_in_days < 1 and not status_info:
+		interval = 'new'
+	else:
+		interval = 'in_transit'
+	return add_to_date(now, minutes=cint(intervals[interval]))
+
+def schedule_next_poll(shipment, tracking_data=None):
+	tracking_data = tracking_data or shipment
+	frappe.db.set_value('Shipment', shipment.name, 'next_tracking_poll',
+		get_next_tracking_poll(shipment, tracking_data.get('tracking_status'), tracking_data.get('tracking_status_info')),
+		update_modified=False)
+
+def add_delivery_notes(shipments):
+	delivery_notes = {}
+	for shipment_chunk in chunk(shipments, 1000):
+		for row in frappe.get_all('Shipment Delivery Note', filters={
+			'parenttype': 'Shipment',
+			'parent': ['in', [s.name for s in shipment_chunk]]
+		}, fields=['parent', 'delivery_note']):
+			delivery_notes.setdefault(row.parent, []).append(row.delivery_note)
+
+	for shipment in shipments:
+		shipment.delivery_notes = delivery_notes.get(shipment.name, [])
+	return shipments
+
+def enqueue_tracking_refresh(shipments, lease=None):
+	# Split the Shipments by provider and into chunks, each chunk is refreshed by its own job.
+	# `lease` is the next poll the Shipments were reserved with, see refresh_tracking.
+	by_provider = {}
+	for shipment in shipments:
+		by_provider.setdefault(shipment.service_provider, []).append(shipment)
+
+	for service_provider, provider_shipments in by_provider.items():
+		for shipment_chunk in chunk(provider_shipments, TRACKING_CHUNK_SIZE):
+			frappe.enqueue('erpnext_shipping.erpnext_shipping.tracking.refresh_tracking',
+				queue='long', timeout=TRACKING_JOB_TIMEOUT, service_provider=service_provider, shipments=shipment_chunk,
+				lease=lease)
+
+@frappe.whitelist()
+def enqueue_selected_tracking_refresh(shipments):
+	# Refresh tracking of the Shipments selected in the list, in the same batched jobs as the scheduler
+	shipments = frappe.parse_json(shipments)
+	check_shipment_permission(shipments, 'write', _('Not permitted to update Shipments'))
+
+	open_shipments = get_open_shipments(filters={'name': ['in', shipments]})
+	enqueue_tracking_refresh(open_shipments)
+	frappe.msgprint(_('Updating tracking of {0} Shipments in the background.').format(len(open_shipments)),
+		alert=True)
+
+def refresh_tracking(service_provider, shipments, lease=None):
+	# Background job: refresh tracking for Shipments of one provider, with bounded concurrency
+	if lease:
+		shipments = get_leased_shipments(shipments, lease)
+		if not shipments:
+			return
+	stats = frappe._dict(service_provider=service_provider, shipments=len(shipments),
+		updated=0, suppressed=0, no_data=0, failed=0)
+	started = time.monotonic()
+
+	tracking_data, failed = fetch_tracking_data(service_provider, shipments)
+	for i, shipment in enumerate(shipments, start=1):
+		if shipment.shipment_id in failed:
+			# Back off as if nothing changed, instead of retrying on every tick
+			schedule_next_poll(shipment)
+			status = 'failed'
+		else:
+			status = save_tracking_data(shipment, tracking_data.get(shipment.shipment_id))
+		stats[status] += 1
+		if i % TRACKING_COMMIT_BATCH_SIZE == 0:
+			frappe.db.commit()
+	frappe.db.commit()
+
+	stats.seconds = flt(time.monotonic() - started, 2)
+	stats.per_second = flt(stats.shipments / stats.seconds, 2) if stats.seconds else 0
+	log_tracking_stats(stats)
+	return stats
+
+def get_leased_shipments(shipments, lease):
+	# The Shipments still reserved with this job's lease. If the job waited in the queue past its lease,
+	# a later tick has reserved them again for another job, which tracks them instead.
+	leases = dict(frappe.get_all('Shipment', filters={'name': ['in', [s.name for s in shipments]]},
+		fields=['name', 'next_tracking_poll'], as_list=True))
+	return [s for s in shipments if leases.get(s.name) and get_datetime(leases[s.name]) == get_datetime(lease)]
+
+def fetch_tracking_data(service_provider, shipments):
+	# Return {shipment_id: tracking data} and the shipment_ids that could not be tracked.
+	# Uses the carrier's batch endpoint where the provider has one, single calls for the rest.
+	concurrency = get_tracking_concurrency(service_provider)
+	tracking_data, failed = {}, set()
+
+	if hasattr(PROVIDERS[service_provider], 'get_tracking_data_batch'):
+		batches = chunk(shipments, PROVIDERS[service_provider].tracking_batch_size)
+		outcome = run_concurrently({i: partial(call_provider, service_provider, 'get_tracking_data_batch', batch)
+			for i, batch in enumerate(batches)}, max_workers=concurrency)
+		for result in outcome.results.values():
+			tracking_data.update(result or {})
+		for error in outcome.errors.values():
+			frappe.log_error(title=_('Error while tracking {0} Shipments').format(service_provider), message=repr(error))
+		# Shipments the batch calls didn't cover are tracked one by one
+		shipments = [s for s in shipments if s.shipment_id not in tracking_data]
+
+	def track_slice(shipment_slice):
+		slice_data, slice_failed = {}, []
+		for shipment in shipment_slice:
+			try:
+				slice_data[shipment.shipment_id] = call_provider(service_provider, 'get_tracking_data', shipment.shipment_id)
+			except Exception:
+				frappe.log_error(title=_('Error while refreshing tracking for Shipment {0}').format(shipment.name))
+				slice_failed.append(shipment.shipment_id)
+		return slice_data, slice_failed
+
+	outcome = run_in_slices(track_slice, shipments, concurrency)
+	for i, (slice_data, slice_failed) in outcome.results.items():
+		tracking_data.update(slice_data)
+		failed.update(slice_failed)
+	for i, error in outcome.errors.items():
+		frappe.log_error(title=_('Error while tracking {0} Shipments').format(service_provider), message=repr(error))
+		failed.update(s.shipment_id for s in outcome.slices[i])
+	return tracking_data, failed
+
+def save_tracking_data(shipment, tracking_data):
+	# Write one Shipment's tracking data, committed with the rest of the batch
+	from erpnext_shipping.erpnext_shipping.shipping import set_tracking_data
+
+	frappe.db.savepoint(TRACKING_SAVEPOINT)
+	try:
+		status = 'no_data'
+		if tracking_data:
+			# Only write the Shipment and its Delivery Notes if the carrier reports something new
+			changed = set_tracking_data(shipment.name, tracking_data, shipment.delivery_notes, current=shipment)
+			status = 'updated' if changed else 'suppressed'
+		schedule_next_poll(shipment, tracking_data)
+		return status
+	except Exception:
+		frappe.db.rollback(save_point=TRACKING_SAVEPOINT)
+		frappe.log_error(title=_('Error while refreshing tracking for Shipment {0}').format(shipment.name))
+		schedule_next_poll(shipment)
+		return 'failed'
+
+def get_tracking_concurrency(service_provider):
+	concurrency = (frappe.conf.get('shipping_tracking_concurrency') or {}).get(service_provider)
+	return cint(concurrency) or DEFAULT_TRACKING_CONCURRENCY
+
+def log_tracking_stats(stats):
+	frappe.logger('erpnext_shipping').info(
+		'Tracking refresh for {service_provider}: {shipments} shipments in {seconds}s ({per_second}/s), '
+		'{updated} updated, {suppressed} unchanged and suppressed, {no_data} without data, {failed} failed'.format(**stats))
+
+	# Running totals per provider, see get_tracking_stats
+	for counter in TRACKING_COUNTERS:
+		frappe.cache().incrby(get_stats_key(stats.service_provider, counter), stats[counter])
+	frappe.cache().incrbyfloat(get_stats_key(stats.service_provider, 'seconds'), stats.seconds)
+
+def count_suppressed(service_provider):
+	# Unchanged updates suppressed outside of the scheduled refresh, e.g. repeated webhooks
+	frappe.cache().incr(get_stats_key(service_provider, 'suppressed'))
+
+def get_stats_key(service_provider, counter):
+	return frappe.cache().make_key(TRACKING_STATS_KEY.format(service_provider, counter))
+
+@frappe.whitelist()
+def get_tracking_stats():
+	# Tracking refresh totals per provider: shipments, suppressed writes, failures and throughput
+	frappe.only_for('System Manager')
+	stats = {}
+	for service_provider in PROVIDERS:
+		counters = {counter: cint(frappe.cache().get(get_stats_key(service_provider, counter)))
+			for counter in TRACKING_COUNTERS}
+		if not any(counters.values()):
+			continue
+		seconds = flt(frappe.cache().get(get_stats_key(service_provider, 'seconds')))
+		counters['seconds'] = flt(seconds, 2)
+		counters['per_second'] = flt(counters['shipments'] / seconds, 2) if seconds else 0
+		stats[service_provider] = counters
+	return stats
+
+def chunk(items, size):
+	return [items[i:i + size] for i in range(0, len(items), size)]
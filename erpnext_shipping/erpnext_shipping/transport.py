@@ -0,0 +1,88 @@
+# Copyright (c) 2023, Frappe and contributors
+# For license information, please see license.txt
+
+import frappe
+import gzip
+import http.cookiejar
+import json
+import os
+import requests
+import threading
+from requests.adapters import HTTPAdapter
+from six import string_types
+from six.moves.urllib.parse import urlparse
+
+# Seconds to wait for a connection and for a response, override per provider with
+# `shipping_http_timeouts` in site_config.json, e.g. {"LetMeShip": {"connect": 5, "read": 60}}
+DEFAULT_TIMEOUTS = {'connect': 5, 'read': 30}
+# Connections kept alive per carrier host, site and process
+POOL_SIZE = 20
+
+# One keep-alive session per process, site and carrier host
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(url):
+	key = (os.getpid(), frappe.local.site, urlparse(url).netloc)
+	session = _sessions.get(key)
+	if not session:
+		with _sessions_lock:
+			session = _sessions.get(key)
+			if not session:
+				session = requests.Session()
+				# Carriers are authenticated per request, cookies they set must not reach other requests
+				session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+				adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+				session.mount('https://', adapter)
+				session.mount('http://', adapter)
+				_sessions[key] = session
+	return session
+
+def get_timeout(service_provider):
+	timeouts = dict(DEFAULT_TIMEOUTS)
+	timeouts.update((frappe.conf.get('shipping_http_timeouts') or {}).get(service_provider) or {})
+	return (timeouts['connect'], timeouts['read'])
+
+def use_gzip(service_provider):
+	# Providers listed in `shipping_http_gzip` get gzip compressed request bodies.
+	# Compressed responses are always accepted.
+	return service_provider in (frappe.conf.get('shipping_http_gzip') or [])
+
+def request(service_provider, method, url, **kwargs):
+	# Send a request to a carrier over the pooled session, with the provider's timeouts
+	kwargs.setdefault('timeout', get_timeout(service_provider))
+	if use_gzip(service_provider):
+		compress_body(kwargs)
+	return get_session(url).request(method, url, **kwargs)
+
+def compress_body(kwargs):
+	body = kwargs.pop('json', None)
+	if body is not None:
+		kwargs['data'] = json.dumps(body)
+		kwargs['headers'] = dict(kwargs.get('headers') or {}, **{'Content-Type': 'application/json'})
+	body = kwargs.get('data')
+	if not body:
+		return
+	if isinstance(body, string_types):
+		body = body.encode('utf-8')
+	if isinstance(body, bytes):
+		kwargs['data'] = gzip.compress(body)
+		kwargs['headers'] = dict(kwargs.get('headers') or {}, **{'Content-Encoding': 'gzip'})
+
+def get(service_provider, url, **kwargs):
+	return request(service_provider, 'GET', url, **kwargs)
+
+def post(service_provider, url, **kwargs):
+	return request(service_provider, 'POST', url, **kwargs)
+
+def make_get_request(service_provider, url, **kwargs):
+	# Same contract as frappe.integrations.utils.make_get_request: raise on HTTP errors, return JSON
+	response = get(service_provider, url, **kwargs)
+	response.raise_for_status()
+	return response.json()
+
+def make_post_request(service_provider, url, **kwargs):
+	# Same contract as frappe.integrations.utils.make_post_request: raise on HTTP errors, return JSON
+	response = post(service_provider, url, **kwargs)
+	response.raise_for_status()
+	return response.json()
@@ -4,8 +4,13 @@
 from __future__ import unicode_literals
 import frappe
 import json
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
 from frappe import _
 
+SHIPMENT_PARCEL_FIELDS = ['length', 'width', 'height', 'weight', 'count']
+
 def get_tracking_url(carrier, tracking_number):
 	# Return the formatted Tracking URL.
 	tracking_url = ''
@@ -40,13 +45,15 @@ def get_contact(contact_name):
 	return contact
 
 def match_parcel_service_type_carrier(shipment_prices, reference):
-	from erpnext_shipping.erpnext_shipping.doctype.parcel_service_type.parcel_service_type import match_parcel_service_type_alias
+	# Annotate all prices with their Parcel Service Type and preferred flag from the cached index
+	from erpnext_shipping.erpnext_shipping.doctype.parcel_service_type.parcel_service_type import get_parcel_service_type_index
 
-	for idx, prices in enumerate(shipment_prices):
-		service_name = match_parcel_service_type_alias(prices.get(reference[0]), prices.get(reference[1]))
-		is_preferred = frappe.db.get_value('Parcel Service Type', service_name, 'show_in_preferred_services_list')
-		shipment_prices[idx].service_name = service_name
-		shipment_prices[idx].is_preferred = is_preferred
+	index = get_parcel_service_type_index()
+	for prices in shipment_prices:
+		service_name = prices.get(reference[0])
+		service_name = index['aliases'].get((prices.get(reference[1]), service_name), service_name)
+		prices.service_name = service_name
+		prices.is_preferred = index['preferred'].get(service_name)
 	return shipment_prices
 
 def show_error_alert(action):
@@ -60,26 +67,119 @@ def get_lat_long(gps_object):
 		if feature["geometry"]["type"] == "Point":
 			return str(feature["geometry"]["coordinates"][1]), str(feature["geometry"]["coordinates"][0])
 
-def update_tracking_info_daily():
-	# Daily scheduled event to update Tracking info for not delivered Shipments
-	# Also Updates the related Delivery Notes
-	from erpnext_shipping.erpnext_shipping.shipping import update_tracking
-	shipments = frappe.get_all('Shipment', filters={
-		'docstatus': 1,
-		'status': 'Booked',
-		'shipment_id': ['!=', ''],
-		'tracking_status': ['!=', 'Delivered'],
-	})
-	for shipment in shipments:
-		shipment_doc = frappe.get_doc('Shipment', shipment.name)
-		try:
-			tracking_info = update_tracking(shipment_doc.name, shipment_doc.service_provider, shipment_doc.shipment_id,
-					shipment_doc.shipment_delivery_note)
-
-			if tracking_info:
-				fields = ['awb_number', 'tracking_status', 'tracking_status_info', 'tracking_url', 'delivered_at']
-				for field in fields:
-					shipment_doc.db_set(field, tracking_info.get(field, None))
-				frappe.db.commit()
-		except Exception:
-			continue
+def get_site_context():
+	# Capture what a worker thread needs to open its own connection to this site
+	return frappe._dict(
+		site=frappe.local.site,
+		sites_path=frappe.local.sites_path,
+		user=frappe.session.user
+	)
+
+def run_in_site_context(context, fn, *args, **kwargs):
+	# Run `fn` on the current (worker) thread with its own Frappe connection.
+	# Messages raised by `fn` are returned so the caller can replay them.
+	frappe.init(site=context.site, sites_path=context.sites_path)
+	frappe.connect()
+	try:
+		frappe.set_user(context.user)
+		result = fn(*args, **kwargs)
+		frappe.db.commit()
+		return result, list(frappe.local.message_log)
+	finally:
+		frappe.destroy()
+
+def run_concurrently(jobs, timeout=None, max_workers=None, on_result=None):
+	"""Run `jobs` ({key: callable}) on worker threads, each with its own site context.
+
+	`timeout` is either a number of seconds or a {key: seconds} mapping, measured from
+	submission. `on_result(key, result)` is called on this thread as each job finishes.
+	Returns a dict with the `results` that finished in time, the `errors` raised by jobs
+	and the keys that `timed_out`. Timed out jobs are left to finish in the background,
+	the caller does not wait for them."""
+	outcome = frappe._dict(results={}, errors={}, timed_out=[])
+	if not jobs:
+		return outcome
+
+	context = get_site_context()
+	executor = ThreadPoolExecutor(max_workers=max_workers or len(jobs))
+	started = time.monotonic()
+	pending = {executor.submit(run_in_site_context, context, job): key for key, job in jobs.items()}
+	deadlines = {}
+	for future, key in pending.items():
+		seconds = timeout.get(key) if isinstance(timeout, dict) else timeout
+		if seconds is not None:
+			deadlines[future] = started + seconds
+
+	try:
+		while pending:
+			next_deadline = min((deadlines[f] for f in pending if f in deadlines), default=None)
+			wait_for = None if next_deadline is None else max(0, next_deadline - time.monotonic())
+			done, not_done = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+
+			for future in done:
+				key = pending.pop(future)
+				try:
+					result, messages = future.result()
+				except Exception as e:
+					outcome.errors[key] = e
+					continue
+				outcome.results[key] = result
+				frappe.local.message_log.extend(messages)
+				if on_result:
+					on_result(key, result)
+
+			now = time.monotonic()
+			for future in not_done:
+				if future in deadlines and deadlines[future] <= now:
+					future.cancel()
+					outcome.timed_out.append(pending.pop(future))
+	finally:
+		executor.shutdown(wait=False)
+	return outcome
+
+def map_requests(fn, items, max_workers):
+	# `[fn(item) for item in items]` on worker threads, for an `fn` that only sends requests through `transport`.
+	# Unlike `run_concurrently`, the threads get the site and its config but no database connection.
+	# The first error raised by `fn` is raised here.
+	site, conf = frappe.local.site, frappe.local.conf
+
+	def run(item):
+		frappe.local.site = site
+		frappe.local.conf = conf
+		return fn(item)
+
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		return list(executor.map(run, items))
+
+def get_slice_jobs(fn, items, workers):
+	# {i: job} running `fn` on up to `workers` round robin slices of `items`, for `run_concurrently`.
+	# Each worker gets its own slice so it reuses one database connection.
+	return {i: partial(fn, items[i::workers]) for i in range(min(workers, len(items)))}
+
+def run_in_slices(fn, items, workers, on_result=None):
+	# Run `fn(slice)` for the slices of `get_slice_jobs` at the same time, see `run_concurrently`.
+	# The outcome is keyed by slice index, its `slices` holds the items of each.
+	jobs = get_slice_jobs(fn, items, workers)
+	outcome = run_concurrently(jobs, on_result=on_result)
+	outcome.slices = {i: items[i::workers] for i in jobs}
+	return outcome
+
+def get_shipment_parcels(shipments):
+	# {shipment: [parcel, ...]} with the SHIPMENT_PARCEL_FIELDS of each parcel, in table order
+	parcels = {}
+	for parcel in frappe.get_all('Shipment Parcel', filters={'parent': ['in', shipments], 'parenttype': 'Shipment'},
+		fields=['parent'] + SHIPMENT_PARCEL_FIELDS, order_by='idx'):
+		parcels.setdefault(parcel.pop('parent'), []).append(parcel)
+	return parcels
+
+def check_shipment_permission(shipments, ptype, message):
+	# Throw `message` unless the user has `ptype` on each of the Shipments, not only on Shipments in general
+	if not frappe.has_permission('Shipment', ptype):
+		frappe.throw(message, frappe.PermissionError)
+	permitted = frappe.get_list('Shipment', filters={'name': ['in', list(shipments)]}, pluck='name',
+		limit_page_length=0)
+	if ptype != 'read':
+		permitted = [shipment for shipment in permitted if frappe.has_permission('Shipment', ptype, doc=shipment)]
+	not_permitted = set(shipments) - set(permitted)
+	if not_permitted:
+		frappe.throw('{0}: {1}'.format(message, ', '.join(sorted(not_permitted))), frappe.PermissionError)
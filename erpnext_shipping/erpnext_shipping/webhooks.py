@@ -0,0 +1,98 @@
+# Copyright (c) 2023, Frappe and contributors
+# For license information, please see license.txt
+
+import frappe
+import hashlib
+import hmac
+from frappe.utils.password import get_decrypted_password
+from erpnext_shipping.erpnext_shipping.doctype.sendcloud import sendcloud
+from erpnext_shipping.erpnext_shipping.doctype.sendcloud.sendcloud import SENDCLOUD_PROVIDER
+from erpnext_shipping.erpnext_shipping.doctype.shiprocket import shiprocket
+from erpnext_shipping.erpnext_shipping.doctype.shiprocket.shiprocket import SHIPROCKET_PROVIDER
+
+# Receivers only check the request and queue the update, so bursts are absorbed by the workers.
+# Register them at the carriers as https://<site>/api/method/erpnext_shipping.erpnext_shipping.webhooks.<receiver>
+
+@frappe.whitelist(allow_guest=True, methods=['POST'])
+def sendcloud_parcel_status():
+	# SendCloud signs the body with the API secret, see the Sendcloud-Signature header
+	secret = get_decrypted_password(SENDCLOUD_PROVIDER, SENDCLOUD_PROVIDER, 'api_secret', raise_exception=False)
+	signature = hmac.new((secret or '').encode(), frappe.request.get_data(), hashlib.sha256).hexdigest()
+	if not secret or not hmac.compare_digest(signature, frappe.get_request_header('Sendcloud-Signature') or ''):
+		raise frappe.AuthenticationError
+
+	payload = frappe.parse_json(frappe.request.get_data(as_text=True))
+	if payload.get('action') != 'parcel_status_changed' or not payload.get('parcel'):
+		return
+
+	parcel = payload['parcel']
+	parcel_id = str(parcel['id'])
+	for shipment in find_shipments(SENDCLOUD_PROVIDER, 'shipment_id', parcel_id, separator=', '):
+		if shipment.shipment_id == parcel_id:
+			enqueue_tracking_update(shipment.name, sendcloud.get_tracking_dict([parcel]))
+		else:
+			# The status of a Shipment with several parcels combines all of them, poll for the others
+			enqueue_tracking_update(shipment.name)
+
+@frappe.whitelist(allow_guest=True, methods=['POST'])
+def order_status_update():
+	# Shiprocket sends the token configured in its settings as x-api-key. The name of this
+	# receiver must not contain "shiprocket", Shiprocket refuses such webhook URLs.
+	token = get_decrypted_password(SHIPROCKET_PROVIDER, SHIPROCKET_PROVIDER, 'webhook_token', raise_exception=False)
+	if not token or not hmac.compare_digest(token, frappe.get_request_header('x-api-key') or ''):
+		raise frappe.AuthenticationError
+
+	payload = frappe.parse_json(frappe.request.get_data(as_text=True))
+	if not payload.get('awb'):
+		return
+
+	tracking_data = shiprocket.parse_tracking_webhook(payload)
+	for shipment in find_shipments(SHIPROCKET_PROVIDER, 'awb_number', payload['awb']):
+		enqueue_tracking_update(shipment.name, tracking_data)
+
+def find_shipments(service_provider, fieldname, value, separator=None):
+	# Booked Shipments of the provider whose field is the value, or contains it in a separated list
+	filters = {'docstatus': 1, 'service_provider': service_provider, fieldname: value}
+	if separator:
+		filters[fieldname] = ['like', '%{0}%'.format(value)]
+	shipments = frappe.get_all('Shipment', filters=filters, fields=list({'name', 'shipment_id', fieldname}))
+	if separator:
+		shipments = [s for s in shipments if value in s[fieldname].split(separator)]
+	return shipments
+
+def enqueue_tracking_update(shipment, tracking_data=None):
+	frappe.enqueue('erpnext_shipping.erpnext_shipping.webhooks.apply_tracking_update',
+		queue='short', shipment=shipment, tracking_data=tracking_data)
+
+def apply_tracking_update(shipment, tracking_data=None):
+	# Background job: write pushed tracking data, or poll the provider if the push is incomplete
+	from erpnext_shipping.erpnext_shipping.providers import call_provider
+	from erpnext_shipping.erpnext_shipping.shipping import SHIPMENT_TRACKING_FIELDS, set_tracking_data
+	from erpnext_shipping.erpnext_shipping.tracking import add_delivery_notes, count_suppressed, schedule_next_poll
+
+	shipments = frappe.get_all('Shipment', filters={'name': shipment},
+		fields=['name', 'service_provider', 'shipment_id', 'creation', 'tracking_fingerprint'] + SHIPMENT_TRACKING_FIELDS)
+	if not shipments:
+		# Deleted after the update was queued
+		return
+	shipment_data = add_delivery_notes(shipments)[0]
+	if not tracking_data:
+		tracking_data = call_provider(shipment_data.service_provider, 'get_tracking_data', shipment_data.shipment_id)
+
+	changed = tracking_data and set_tracking_data(shipment, tracking_data, shipment_data.delivery_notes, current=shipment_data)
+	# A pushed update counts as a poll, the next poll is only a fallback
+	schedule_next_poll(shipment_data, tracking_data)
+	frappe.db.commit()
+	if changed:
+		notify_update(shipment)
+	elif tracking_data:
+		# Carriers resend statuses, e.g. on retries
+		count_suppressed(shipment_data.service_provider)
+
+def notify_update(shipment):
+	# Let open forms of the Shipment know it changed
+	frappe.publish_realtime('doc_update', {
+		'doctype': 'Shipment',
+		'name': shipment,
+		'modified': frappe.db.get_value('Shipment', shipment, 'modified')
+	}, doctype='Shipment', docname=shipment)
@@ -36,7 +36,9 @@ app_license = "MIT"
 doctype_js = {
 	"Shipment" : "public/js/shipment.js"
 }
-# doctype_list_js = {"doctype" : "public/js/doctype_list.js"}
+doctype_list_js = {
+	"Shipment" : "public/js/shipment_list.js"
+}
 # doctype_tree_js = {"doctype" : "public/js/doctype_tree.js"}
 # doctype_calendar_js = {"doctype" : "public/js/doctype_calendar.js"}
 
@@ -106,8 +108,18 @@ after_migrate = "erpnext_shipping.erpnext_shipping.patches.create_custom_deliver
 # ---------------
 
 scheduler_events = {
-	"daily": [
-		"erpnext_shipping.erpnext_shipping.utils.update_tracking_info_daily"
+	"cron": {
+		"*/5 * * * *": [
+			"erpnext_shipping.erpnext_shipping.tracking.poll_due_shipments",
+			"erpnext_shipping.erpnext_shipping.shiprocket_serviceability.build_serviceability_indexes"
+		],
+		"*/15 * * * *": [
+			"erpnext_shipping.erpnext_shipping.shiprocket_pickups.flush_pickup_batches"
+		]
+	},
+	"hourly": [
+		"erpnext_shipping.erpnext_shipping.doctype.shiprocket.shiprocket.refresh_pickup_locations",
+		"erpnext_shipping.erpnext_shipping.doctype.sendcloud.sendcloud.sync_shipping_methods"
 	]
 }
 
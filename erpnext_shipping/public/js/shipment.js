@@ -32,23 +32,27 @@ frappe.ui.form.on('Shipment', {
 
 	fetch_shipping_rates: function(frm) {
 		if (!frm.doc.shipment_id) {
+			const args = {
+				shipment_doc: frm.doc.name,
+				pickup_from_type: frm.doc.pickup_from_type,
+				delivery_to_type: frm.doc.delivery_to_type,
+				pickup_address_name: frm.doc.pickup_address_name,
+				delivery_address_name: frm.doc.delivery_address_name,
+				shipment_parcel: frm.doc.shipment_parcel,
+				description_of_content: frm.doc.description_of_content,
+				pickup_date: frm.doc.pickup_date,
+				pickup_contact_name: frm.doc.pickup_from_type === 'Company' ? frm.doc.pickup_contact_person : frm.doc.pickup_contact_name,
+				delivery_contact_name: frm.doc.delivery_contact_name,
+				value_of_goods: frm.doc.value_of_goods
+			};
+			if (frappe.realtime.socket && frappe.realtime.socket.connected) {
+				return frm.events.stream_shipping_rates(frm, args);
+			}
 			frappe.call({
 				method: "erpnext_shipping.erpnext_shipping.shipping.fetch_shipping_rates",
 				freeze: true,
 				freeze_message: __("Fetching Shipping Rates"),
-				args: {
-					shipment_doc: frm.doc.name,
-					pickup_from_type: frm.doc.pickup_from_type,
-					delivery_to_type: frm.doc.delivery_to_type,
-					pickup_address_name: frm.doc.pickup_address_name,
-					delivery_address_name: frm.doc.delivery_address_name,
-					shipment_parcel: frm.doc.shipment_parcel,
-					description_of_content: frm.doc.description_of_content,
-					pickup_date: frm.doc.pickup_date,
-					pickup_contact_name: frm.doc.pickup_from_type === 'Company' ? frm.doc.pickup_contact_person : frm.doc.pickup_contact_name,
-					delivery_contact_name: frm.doc.delivery_contact_name,
-					value_of_goods: frm.doc.value_of_goods
-				},
+				args: args,
 				callback: function(r) {
 					if (r.message && r.message.length) {
 						select_from_available_services(frm, r.message);
@@ -64,6 +68,47 @@ frappe.ui.form.on('Shipment', {
 		}
 	},
 
+	stream_shipping_rates: function(frm, args) {
+		// Show rates as each provider answers instead of waiting for all of them
+		const request_id = frappe.utils.get_random(10);
+		const selector = select_from_available_services(frm, [], true);
+		const handler = function(data) {
+			if (data.request_id !== request_id) {
+				return;
+			}
+			if (!data.done) {
+				selector.add_services(data.rates || []);
+				return;
+			}
+			frappe.realtime.off("shipping_rates", handler);
+			if (data.error) {
+				frappe.show_alert({message: data.error, indicator: "red"});
+			}
+			if ((data.timed_out || []).length) {
+				frappe.show_alert({
+					message: __("{0} did not respond in time, showing rates from the other providers.", [data.timed_out.join(", ")]),
+					indicator: "orange"
+				});
+			}
+			if ((data.failed || []).length) {
+				frappe.show_alert({
+					message: __("Could not fetch rates from {0}.", [data.failed.join(", ")]),
+					indicator: "orange"
+				});
+			}
+			selector.done();
+		};
+		frappe.realtime.on("shipping_rates", handler);
+		frappe.call({
+			method: "erpnext_shipping.erpnext_shipping.shipping.fetch_shipping_rates_async",
+			args: Object.assign({request_id: request_id}, args),
+			error: function() {
+				frappe.realtime.off("shipping_rates", handler);
+				selector.done();
+			}
+		});
+	},
+
 	print_shipping_label: function(frm) {
 		frappe.call({
 			method: "erpnext_shipping.erpnext_shipping.shipping.print_shipping_label",
@@ -75,7 +120,8 @@ frappe.ui.form.on('Shipment', {
 			},
 			callback: function(r) {
 				if (r.message) {
-					if (frm.doc.service_provider == "LetMeShip") {
+					// LetMeShip returns the label's bytes, unless it is served from the label store
+					if (frm.doc.service_provider == "LetMeShip" && r.message.startsWith("[")) {
 						var array = JSON.parse(r.message);
 						// Uint8Array for unsigned bytes
 						array = new Uint8Array(array);
@@ -119,10 +165,8 @@ frappe.ui.form.on('Shipment', {
 	}
 });
 
-function select_from_available_services(frm, available_services) {
-	var headers = [ __("Service Provider"), __("Parcel Service"), __("Parcel Service Type"), __("Price"), "" ];
-
-	const arranged_services = available_services.reduce((prev, curr) => {
+function arrange_services(available_services) {
+	return available_services.reduce((prev, curr) => {
 		if (curr.is_preferred) {
 			prev.preferred_services.push(curr);
 		} else {
@@ -130,12 +174,20 @@ function select_from_available_services(frm, available_services) {
 		}
 		return prev;
 	}, { preferred_services: [], other_services: [] });
+}
 
-	frm.render_available_services = function(dialog, headers, arranged_services){
+function select_from_available_services(frm, available_services, loading) {
+	var headers = [ __("Service Provider"), __("Parcel Service"), __("Parcel Service Type"), __("Price"), "" ];
+
+	let services = available_services.slice();
+	let arranged_services = arrange_services(services);
+	loading = !!loading;
+
+	frm.render_available_services = function(dialog, headers, arranged_services, loading){
 		frappe.require("erpnext_shipment_service_selector.bundle.js", function() {
 			dialog.fields_dict.available_services.$wrapper.html(
 				frappe.render_template('erpnext_shipment_service_selector',
-					{'header_columns': headers, 'data': arranged_services}
+					{'header_columns': headers, 'data': arranged_services, 'loading': loading}
 				)
 			);
 		});
@@ -157,7 +209,7 @@ function select_from_available_services(frm, available_services) {
 		delivery_notes.push(d.delivery_note);
 	});
 
-	frm.render_available_services(dialog, headers, arranged_services);
+	frm.render_available_services(dialog, headers, arranged_services, loading);
 
 	dialog.$body.on('click', '.btn', function() {
 		let service_type = $(this).attr("data-type");
@@ -201,4 +253,22 @@ function select_from_available_services(frm, available_services) {
 		dialog.hide();
 	};
 	dialog.show();
+
+	return {
+		add_services: function(new_services) {
+			// Merge rates from another provider and keep the list sorted by price
+			services = services.concat(new_services).sort((a, b) => flt(a.total_price) - flt(b.total_price));
+			arranged_services = arrange_services(services);
+			frm.render_available_services(dialog, headers, arranged_services, loading);
+		},
+		done: function() {
+			loading = false;
+			if (!services.length) {
+				dialog.hide();
+				frappe.msgprint({message:__("No Shipment Services available"), title:__("Note")});
+				return;
+			}
+			frm.render_available_services(dialog, headers, arranged_services, loading);
+		}
+	};
 }
\ No newline at end of file
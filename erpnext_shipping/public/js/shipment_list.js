@@ -0,0 +1,82 @@
+// Copyright (c) 2023, Frappe and contributors
+// For license information, please see license.txt
+
+frappe.listview_settings['Shipment'] = frappe.listview_settings['Shipment'] || {};
+
+const erpnext_shipping_list_onload = frappe.listview_settings['Shipment'].onload;
+
+frappe.listview_settings['Shipment'].onload = function(listview) {
+	if (erpnext_shipping_list_onload) {
+		erpnext_shipping_list_onload(listview);
+	}
+
+	listview.page.add_actions_menu_item(__('Fetch Shipping Rates'), function() {
+		const shipments = listview.get_checked_items(true);
+		frappe.call({
+			method: "erpnext_shipping.erpnext_shipping.rate_shopping.enqueue_bulk_rate_shopping",
+			args: {shipments: shipments}
+		});
+	}, false);
+
+	listview.page.add_actions_menu_item(__('Update Tracking'), function() {
+		const shipments = listview.get_checked_items(true);
+		frappe.call({
+			method: "erpnext_shipping.erpnext_shipping.tracking.enqueue_selected_tracking_refresh",
+			args: {shipments: shipments}
+		});
+	}, false);
+
+	listview.page.add_actions_menu_item(__('Print Shipping Labels'), function() {
+		const shipments = listview.get_checked_items(true);
+		frappe.call({
+			method: "erpnext_shipping.erpnext_shipping.labels.enqueue_bulk_labels",
+			args: {shipments: shipments}
+		});
+	}, false);
+
+	listview.page.add_actions_menu_item(__('Book with Quoted Rates'), function() {
+		const shipments = listview.get_checked_items(true);
+		frappe.call({
+			method: "erpnext_shipping.erpnext_shipping.booking.enqueue_bulk_booking",
+			args: {shipments: shipments}
+		});
+	}, false);
+
+	frappe.realtime.on("bulk_booking", function(summary) {
+		let message = __("Booked {0} of {1} Shipments.", [summary.booked, summary.shipments]);
+		if (summary.failed.length) {
+			message += "<br><br>" + summary.failed.map(d => `${d.shipment}: ${d.error}`).join("<br>");
+		}
+		frappe.msgprint({
+			message: message,
+			title: __("Shipments Booked"),
+			indicator: summary.failed.length ? "orange" : "green"
+		});
+		listview.refresh();
+	});
+
+	frappe.realtime.on("bulk_labels", function(summary) {
+		let message = __("Merged {0} of {1} labels.", [summary.labels, summary.shipments]);
+		if (summary.failed.length) {
+			message += " " + __("No label for {0}.", [summary.failed.join(", ")]);
+		}
+		if (summary.file_url) {
+			message += ` <a href="${encodeURI(summary.file_url)}" target="_blank">${__("Download")}</a>`;
+		}
+		frappe.msgprint({
+			message: message,
+			title: __("Shipping Labels"),
+			indicator: summary.failed.length ? "orange" : "green"
+		});
+	});
+
+	frappe.realtime.on("bulk_rate_shopping", function(summary) {
+		frappe.msgprint({
+			message: __("Quoted {0} of {1} Shipments. No rates for {2}, failed for {3}.",
+				[summary.quoted, summary.shipments, summary.no_rates, summary.failed]),
+			title: __("Shipping Rates Fetched"),
+			indicator: summary.failed ? "orange" : "green"
+		});
+		listview.refresh();
+	});
+};